@@ -17,52 +17,95 @@
 
 from .util import *
 from .surface import *
-from scipy.spatial.transform import Rotation as R
+from .jit import *
 import numpy as np
+import copy
+
+GLSL_IDENTITY = 'mat3(1.,0.,0.,0.,1.,0.,0.,0.,1.)' # shapes can skip rotating by this
 
 default_surface = UniformSurface(SurfaceProp())
 
 class SDF:
     '''Base class for all geometry primatives, implementing common functionality'''
     
-    def __init__(self,surface=default_surface,translate=None,rotate_seq='xyz',rotate=None,rounding=None):
+    def __init__(self,surface=default_surface,translate=None,rotate_seq='ZYX',rotate=None,rounding=None):
+        self.set_transform(None if rotate is None else euler_to_mat(rotate_seq,rotate),translate)
+        self.surface = surface
+        self.rounding = rounding
+        
+    def set_transform(self,rotate,translate):
+        '''Sets the rotation matrix and translation mapping parent to local coordinates'''
         if rotate is None:
             self.rotate = None
         else:
-            self.rotate = ZROT(rotate[0]) @ YROT(rotate[1]) @ XROT(rotate[2])
-            #self.rotate = R.from_euler(seq=rotate_seq,angles=rotate).as_matrix()
+            self.rotate = rotate
+            if self.rotate.dtype != object: # Parameters must stay symbolic
+                self.rotate = self.rotate.astype(np.float32)
+            self.rotateT = np.ascontiguousarray(self.rotate.T) # for row-major points
         if translate is None:
             self.translate = None
         else:
-            self.translate = A(translate)
-        self.surface = surface
-        self.rounding = rounding
+            self.translate = A(translate,np.float32)
         
     def __call__(self,pts,properties=False):
         '''Transform coordinates for this primative AND
            Evaluate its signed distance function OR
            Evaluate its surface at the specified points'''
-        pts = self.transform(pts)
-        if properties:
-            return self.props(pts)
-        else:
-            val = self.fn(pts)
-            return val if self.rounding is None else val-self.rounding
+        return self.properties(pts) if properties else self.distance(pts)
+        
+    def distance(self,pts):
+        '''Evaluates the signed distance function at the specified points'''
+        return self.rounded(self.fn(self.transform(pts)))
+        
+    def properties(self,pts):
+        '''Evaluates the surface properties at the specified points'''
+        leaves = self.surface_leaves()
+        if len(leaves) == 1:
+            return self.props(self.transform(pts))
+        _,ids = self.distance_ids(pts)
+        # uniform surfaces are gathered from a table by id; only the rest are evaluated
+        uniform = [leaf.surface.uniform_prop() for leaf in leaves]
+        props = SurfacePropArray.from_props([SurfaceProp() if u is None else u for u in uniform])[ids]
+        varying = [i for i,u in enumerate(uniform) if u is None]
+        if len(varying) > 0:
+            pts = self.transform(pts) # every surface sees coordinates local to this node
+            for i in varying:
+                mask = ids == i
+                if mask.any():
+                    props[mask] = leaves[i].props(pts[mask])
+        return props
+        
+    def distance_ids(self,pts,first=0):
+        '''Evaluates the signed distance function and, in the same walk of the 
+           tree, the index into `surface_leaves` (offset by first) of the node 
+           whose surface applies at each point'''
+        return self.distance(pts),np.full(len(pts),first,dtype=np.int32)
+        
+    def rounded(self,val):
+        '''Applies this node's rounding to its raw distances'''
+        return val if self.rounding is None else val-self.rounding
+        
+    def surface_leaves(self):
+        '''Lists the nodes whose surfaces can apply, in depth-first order'''
+        return [self]
             
     def transform(self,pts):
         if self.rotate is not None:
-            pts = (self.rotate @ pts.T).T
-        if self.translate is not None:
+            pts = pts @ self.rotateT
+            if self.translate is not None:
+                pts -= self.translate # pts is already a fresh copy
+        elif self.translate is not None:
             pts = pts - self.translate
         return pts
             
     def fn(self,pts):
-        '''Implements the signed distance function for the primitive'''
+        '''Implements the signed distance function for the primitive, returning 
+           a new array that callers are free to overwrite'''
         raise Exception('SDF base class cannot be evaluated')
         
     def props(self,pts):
-        '''Calls the configured surface to obtain properties'''
-        return self.surface(pts)
+        '''Calls the configured surface to obtain a SurfacePropArray'''
+        return self.surface.props(pts)
         
     def glsl(self,tx=None,rot=None):
         tx,rot,glsl_tx,glsl_rot = self.glsl_transform(tx,rot)
@@ -83,6 +126,14 @@ class SDF:
         return prop,sfrags
         
     def glsl_transform(self,tx,rot):
+        tx,rot = self.glsl_compose(tx,rot)
+        glsl_tx = 'vec3(0.,0.,0.)' if tx is None else glsl_vec3(tx)
+        identity = rot is None or (rot.dtype != object and np.array_equal(rot,np.eye(3)))
+        glsl_rot = GLSL_IDENTITY if identity else glsl_mat3(rot)
+        return tx,rot,glsl_tx,glsl_rot
+        
+    def glsl_compose(self,tx,rot):
+        '''Composes this node's transform onto its parent's, without formatting GLSL'''
         if self.translate is not None:
             if rot is None:
                 tx = self.translate + tx if tx is not None else self.translate
@@ -90,9 +141,134 @@ class SDF:
                 tx = (rot.T @ self.translate) + tx if tx is not None else (rot.T @ self.translate)
         if self.rotate is not None:
             rot = self.rotate @ rot if rot is not None else self.rotate
-        glsl_tx = 'vec3(0.,0.,0.)' if tx is None else glsl_vec3(tx)
-        glsl_rot = 'mat3(1.,0.,0.,0.,1.,0.,0.,0.,1.)' if rot is None else glsl_mat3(rot)
-        return tx,rot,glsl_tx,glsl_rot
+        return tx,rot
+        
+    def simplify(self,root=True):
+        '''Returns an equivalent tree that is cheaper to evaluate on the CPU. Nodes
+           that change are shallow copies, so the original tree is left intact.'''
+        return self
+        
+    def symbolic(self):
+        '''True if this node's transform depends on Parameters'''
+        return any(x is not None and x.dtype == object for x in (self.rotate,self.translate))
+        
+    def pretransform(self,rotate,translate):
+        '''Returns a copy of this node that first applies a parent's transform'''
+        if rotate is None and translate is None:
+            return self
+        if self.rotate is not None:
+            if translate is not None:
+                translate = self.rotate @ translate
+            rotate = self.rotate if rotate is None else self.rotate @ rotate
+        if self.translate is not None:
+            translate = self.translate if translate is None else translate + self.translate
+        node = copy.copy(self)
+        node.set_transform(rotate,translate)
+        return node
+        
+    def simplify_children(self,root):
+        '''Simplifies a CSG node's children, folding this node's transform into 
+           them and hoisting rounding they share. Returns the rewritten copy.'''
+        node = copy.copy(self)
+        a,b = self.a,self.b
+        if not root and not (self.symbolic() or a.symbolic() or b.symbolic()):
+            # surfaces see the root's coordinates, so only its transform must stay
+            a,b = a.pretransform(self.rotate,self.translate),b.pretransform(self.rotate,self.translate)
+            node.set_transform(None,None)
+        node.a,node.b = a.simplify(False),b.simplify(False)
+        if node.a.rounding is not None and node.a.rounding == node.b.rounding and type(node) is not Subtraction:
+            # min(a-r,b-r) == min(a,b)-r, and likewise for max
+            rounding = node.a.rounding
+            node.a,node.b = copy.copy(node.a),copy.copy(node.b)
+            node.a.rounding = node.b.rounding = None
+            node.rounding = rounding if node.rounding is None else node.rounding+rounding
+        return node
+        
+    def collapse_to(self,child,root):
+        '''Replaces a CSG node by one of its children, when they are equivalent'''
+        moved = root and (child.rotate is not None or child.translate is not None)
+        if self.surface is not None or self.symbolic() or child.symbolic() or moved:
+            return self.simplify_children(root)
+        node = copy.copy(child.pretransform(self.rotate,self.translate))
+        if self.rounding is not None:
+            node.rounding = self.rounding if node.rounding is None else node.rounding+self.rounding
+        return node.simplify(root)
+        
+    def plain(self):
+        '''True if this node only combines its children, with no transform, 
+           surface override, or rounding of its own'''
+        return self.surface is None and self.rotate is None and self.translate is None and self.rounding is None
+        
+    def compile(self):
+        '''Flattens this SDF tree into post-order arrays of 
+           (ops,lchild,rchild,params,affine,rounding,bounds,skip) for `jit.eval_tree`'''
+        nodes = []
+        self.compile_nodes(nodes,np.eye(3),np.zeros(3))
+        ops,lchild,rchild,params,R,T,rounding,bounds,skip = zip(*nodes)
+        return (np.asarray(ops,dtype=np.int8),
+                np.asarray(lchild,dtype=np.int32),
+                np.asarray(rchild,dtype=np.int32),
+                np.asarray(params,dtype=np.float32),
+                np.concatenate([np.asarray(R,dtype=np.float32),np.asarray(T,dtype=np.float32)[:,:,None]],axis=2),
+                np.asarray(rounding,dtype=np.float32),
+                np.asarray(bounds,dtype=np.float32),
+                np.asarray(skip,dtype=np.int32))
+        
+    def compile_nodes(self,nodes,rot,tx):
+        '''Appends this node to `nodes` (after any children) and returns its index'''
+        bound = self.compile_bound(rot,tx)
+        rot,tx = self.compile_transform(rot,tx)
+        op,params = self.compile_geo()
+        params = list(params)+[0.]*(4-len(params))
+        nodes.append((op,-1,-1,params,rot,tx,self.compile_rounding(),bound,-1))
+        return len(nodes)-1
+        
+    def compile_geo(self):
+        raise NotCompilable(f'{type(self)} does not implement compile_geo')
+        
+    def compile_transform(self,rot,tx):
+        '''Composes this node's transform onto the world-to-parent transform,
+           such that local points are rot @ pts - tx'''
+        if self.rotate is not None:
+            rotate = np.asarray(self.rotate,dtype=np.float64)
+            rot = rotate @ rot
+            tx = rotate @ tx
+        if self.translate is not None:
+            tx = tx + np.asarray(self.translate,dtype=np.float64)
+        return rot,tx
+        
+    def compile_rounding(self):
+        return 0. if self.rounding is None else float(self.rounding)
+        
+    def compile_bound(self,rot,tx):
+        '''This node's bounding sphere (cx,cy,cz,r) in world coordinates'''
+        center,radius = self.bound()
+        return list(rot.T @ (center + tx))+[radius]
+        
+    def bound(self):
+        '''Returns (center,radius) of a sphere enclosing this SDF, in the coordinates
+           it is called with. The SDF is never less than the distance to this sphere.'''
+        center,radius = self.bound_geo()
+        if self.translate is not None:
+            center = center + np.asarray(self.translate,dtype=np.float64)
+        if self.rotate is not None:
+            center = np.asarray(self.rotate,dtype=np.float64).T @ center
+        return center,radius+self.compile_rounding()
+        
+    def bound_geo(self):
+        '''Bounding sphere of the primitive in its own coordinates'''
+        return np.zeros(3),np.inf
+        
+def enclosing_sphere(a,b):
+    '''Smallest sphere enclosing the spheres a and b, given as (center,radius)'''
+    (ca,ra),(cb,rb) = a,b
+    dist = L(cb-ca)
+    if ra >= dist+rb:
+        return ca,ra
+    if rb >= dist+ra:
+        return cb,rb
+    radius = (dist+ra+rb)/2
+    return ca+(cb-ca)*(radius-ra)/dist,radius
         
             
 class Intersection(SDF):
@@ -106,20 +282,25 @@ class Intersection(SDF):
         self.surface = surface
         
     def fn(self,pts): 
-        return np.maximum(self.a(pts),self.b(pts))
+        a = self.a.distance(pts)
+        return np.maximum(a,self.b.distance(pts),out=a)
         
-    def props(self,pts):
+    def distance_ids(self,pts,first=0):
         if self.surface is not None:
-            return self.surface(pts)
-        mask = self.a(pts) >= self.b(pts)
-        props = np.empty(len(pts),dtype=SurfaceProp)
-        props[mask] = self.a.props(pts[mask])
-        mask = ~mask
-        props[mask] = self.b.props(pts[mask])
-        return props
+            return super().distance_ids(pts,first)
+        pts = self.transform(pts)
+        a,a_ids = self.a.distance_ids(pts,first)
+        b,b_ids = self.b.distance_ids(pts,first+len(self.a.surface_leaves()))
+        ids = np.where(a >= b,a_ids,b_ids)
+        return self.rounded(np.maximum(a,b,out=a)),ids
+        
+    def surface_leaves(self):
+        if self.surface is not None:
+            return super().surface_leaves()
+        return self.a.surface_leaves()+self.b.surface_leaves()
     
     def glsl(self,tx=None,rot=None):
-        tx,rot,glsl_tx,glsl_rot = self.glsl_transform(tx,rot)
+        tx,rot = self.glsl_compose(tx,rot)
         ageo,aprop,afrags = self.a.glsl(tx=tx,rot=rot)
         bgeo,bprop,bfrags = self.b.glsl(tx=tx,rot=rot)
         geo = f'intersect({ageo},{bgeo})'
@@ -128,6 +309,26 @@ class Intersection(SDF):
         fragments = [Intersection.glsl_function]+afrags+bfrags+sfrags
         return geo,prop,fragments
         
+    def compile_nodes(self,nodes,rot,tx):
+        bound = self.compile_bound(rot,tx)
+        rot,tx = self.compile_transform(rot,tx)
+        a = self.a.compile_nodes(nodes,rot,tx)
+        b = self.b.compile_nodes(nodes,rot,tx)
+        nodes.append((OP_INTERSECTION,a,b,[0.]*4,rot,tx,self.compile_rounding(),bound,-1))
+        return len(nodes)-1
+        
+    def bound_geo(self):
+        a,b = self.a.bound(),self.b.bound()
+        return a if a[1] <= b[1] else b
+        
+    def simplify(self,root=True):
+        a,b = self.a,self.b
+        if a is b or (isinstance(b,Union) and b.plain() and a in (b.a,b.b)):
+            return self.collapse_to(a,root) # a & (a | c) == a
+        if isinstance(a,Union) and a.plain() and b in (a.a,a.b):
+            return self.collapse_to(b,root)
+        return NaryIntersection.flatten(self.simplify_children(root))
+        
     glsl_function = '''
         float intersect(float a, float b) {
             return max(a,b);
@@ -153,20 +354,25 @@ class Union(SDF):
         self.surface = surface
         
     def fn(self,pts): 
-        return np.minimum(self.a(pts),self.b(pts))
+        a = self.a.distance(pts)
+        return np.minimum(a,self.b.distance(pts),out=a)
         
-    def props(self,pts):
+    def distance_ids(self,pts,first=0):
         if self.surface is not None:
-            return self.surface(pts)
-        mask = self.a(pts) <= self.b(pts)
-        props = np.empty(len(pts),dtype=SurfaceProp)
-        props[mask] = self.a.props(pts[mask])
-        mask = ~mask
-        props[mask] = self.b.props(pts[mask])
-        return props
+            return super().distance_ids(pts,first)
+        pts = self.transform(pts)
+        a,a_ids = self.a.distance_ids(pts,first)
+        b,b_ids = self.b.distance_ids(pts,first+len(self.a.surface_leaves()))
+        ids = np.where(a <= b,a_ids,b_ids)
+        return self.rounded(np.minimum(a,b,out=a)),ids
+        
+    def surface_leaves(self):
+        if self.surface is not None:
+            return super().surface_leaves()
+        return self.a.surface_leaves()+self.b.surface_leaves()
         
     def glsl(self,tx=None,rot=None):
-        tx,rot,glsl_tx,glsl_rot = self.glsl_transform(tx,rot)
+        tx,rot = self.glsl_compose(tx,rot)
         ageo,aprop,afrags = self.a.glsl(tx=tx,rot=rot)
         bgeo,bprop,bfrags = self.b.glsl(tx=tx,rot=rot)
         geo = f'join({ageo},{bgeo})'
@@ -175,6 +381,28 @@ class Union(SDF):
         fragments = [Union.glsl_function]+afrags+bfrags+sfrags
         return geo,prop,fragments
         
+    def compile_nodes(self,nodes,rot,tx):
+        bound = self.compile_bound(rot,tx)
+        rot,tx = self.compile_transform(rot,tx)
+        a = self.a.compile_nodes(nodes,rot,tx)
+        b = self.b.compile_nodes(nodes,rot,tx)
+        if np.isfinite(nodes[b][7][3]):
+            # b's subtree starts right after a; skip it if its bound is beyond a
+            nodes[a+1] = nodes[a+1][:-1]+(b,)
+        nodes.append((OP_UNION,a,b,[0.]*4,rot,tx,self.compile_rounding(),bound,-1))
+        return len(nodes)-1
+        
+    def bound_geo(self):
+        return enclosing_sphere(self.a.bound(),self.b.bound())
+        
+    def simplify(self,root=True):
+        a,b = self.a,self.b
+        if a is b or (isinstance(b,Intersection) and b.plain() and a in (b.a,b.b)):
+            return self.collapse_to(a,root) # a | (a & c) == a
+        if isinstance(a,Intersection) and a.plain() and b in (a.a,a.b):
+            return self.collapse_to(b,root)
+        return NaryUnion.flatten(self.simplify_children(root))
+        
     glsl_function = '''
         float join(float a, float b) {
             return min(a,b);
@@ -199,20 +427,26 @@ class Subtraction(SDF):
         self.b = b
         self.surface = surface
     def fn(self,pts): 
-        return np.maximum(self.a(pts),-self.b(pts))
+        a = self.a.distance(pts)
+        b = self.b.distance(pts)
+        return np.maximum(a,np.negative(b,out=b),out=a)
         
-    def props(self,pts):
+    def distance_ids(self,pts,first=0):
         if self.surface is not None:
-            return self.surface(pts)
-        mask = self.a(pts) >= -self.b(pts)
-        props = np.empty(len(pts),dtype=SurfaceProp)
-        props[mask] = self.a.props(pts[mask])
-        mask = ~mask
-        props[mask] = self.b.props(pts[mask])
-        return props
+            return super().distance_ids(pts,first)
+        pts = self.transform(pts)
+        a,a_ids = self.a.distance_ids(pts,first)
+        b,b_ids = self.b.distance_ids(pts,first+len(self.a.surface_leaves()))
+        ids = np.where(a >= -b,a_ids,b_ids)
+        return self.rounded(np.maximum(a,np.negative(b,out=b),out=a)),ids
+        
+    def surface_leaves(self):
+        if self.surface is not None:
+            return super().surface_leaves()
+        return self.a.surface_leaves()+self.b.surface_leaves()
         
     def glsl(self,tx=None,rot=None):
-        tx,rot,glsl_tx,glsl_rot = self.glsl_transform(tx,rot)
+        tx,rot = self.glsl_compose(tx,rot)
         ageo,aprop,afrags = self.a.glsl(tx=tx,rot=rot)
         bgeo,bprop,bfrags = self.b.glsl(tx=tx,rot=rot)
         geo = f'subtract({ageo},{bgeo})'
@@ -221,6 +455,20 @@ class Subtraction(SDF):
         fragments = [Subtraction.glsl_function]+afrags+bfrags+sfrags
         return geo,prop,fragments
         
+    def compile_nodes(self,nodes,rot,tx):
+        bound = self.compile_bound(rot,tx)
+        rot,tx = self.compile_transform(rot,tx)
+        a = self.a.compile_nodes(nodes,rot,tx)
+        b = self.b.compile_nodes(nodes,rot,tx)
+        nodes.append((OP_SUBTRACTION,a,b,[0.]*4,rot,tx,self.compile_rounding(),bound,-1))
+        return len(nodes)-1
+        
+    def bound_geo(self):
+        return self.a.bound()
+        
+    def simplify(self,root=True):
+        return self.simplify_children(root)
+        
     glsl_function = '''
         float subtract(float a, float b) {
             return max(a,-b);
@@ -235,3 +483,113 @@ class Subtraction(SDF):
         }
 
     '''
+        
+class NarySDF(SDF):
+    '''Base class for combining any number of SDFs with one associative operation,
+       evaluated as a single reduction over the stacked child distances'''
+    
+    pair = None # the equivalent binary CSG class
+    
+    def __init__(self,*children,surface=None,**kwargs):
+        '''surface can be specified to override properties of the children'''
+        super().__init__(**kwargs)
+        assert len(children) >= 2, 'n-ary SDFs need at least two children'
+        self.children = children
+        self.surface = surface
+        
+    def stack(self,pts):
+        '''Evaluates every child at pts into a (K,N) array'''
+        first = self.children[0].distance(pts)
+        dists = np.empty((len(self.children),len(first)),dtype=first.dtype)
+        dists[0] = first
+        for i,child in enumerate(self.children[1:],1):
+            dists[i] = child.distance(pts)
+        return dists
+        
+    def distance_ids(self,pts,first=0):
+        if self.surface is not None:
+            return super().distance_ids(pts,first)
+        pts = self.transform(pts)
+        dists = None
+        for i,child in enumerate(self.children):
+            d,child_ids = child.distance_ids(pts,first)
+            if dists is None:
+                dists = np.empty((len(self.children),len(d)),dtype=d.dtype)
+                ids = np.empty((len(self.children),len(d)),dtype=np.int32)
+            dists[i],ids[i] = d,child_ids
+            first += len(child.surface_leaves())
+        pick = self.select(dists),np.arange(dists.shape[1])
+        return self.rounded(dists[pick]),ids[pick]
+        
+    def surface_leaves(self):
+        if self.surface is not None:
+            return super().surface_leaves()
+        return [leaf for child in self.children for leaf in child.surface_leaves()]
+        
+    def binary(self):
+        '''The equivalent left-leaning tree of binary CSG nodes'''
+        node = self.children[0]
+        for child in self.children[1:]:
+            node = self.pair(node,child)
+        node.surface = self.surface
+        node.rounding = self.rounding
+        node.set_transform(self.rotate,self.translate)
+        return node
+        
+    def glsl(self,tx=None,rot=None):
+        return self.binary().glsl(tx=tx,rot=rot)
+        
+    def compile_nodes(self,nodes,rot,tx):
+        return self.binary().compile_nodes(nodes,rot,tx)
+        
+    def bound_geo(self):
+        return self.binary().bound_geo()
+        
+    def simplify(self,root=True):
+        node = copy.copy(self)
+        children = self.children
+        if not root and not (self.symbolic() or any(child.symbolic() for child in children)):
+            children = [child.pretransform(self.rotate,self.translate) for child in children]
+            node.set_transform(None,None)
+        node.children = tuple(child.simplify(False) for child in children)
+        return node
+        
+    @classmethod
+    def flatten(cls,node):
+        '''Rewrites a simplified binary node whose plain children apply the same 
+           operation as one n-ary node, if that merges at least three children'''
+        children = []
+        for child in (node.a,node.b):
+            if isinstance(child,cls) and child.plain():
+                children.extend(child.children)
+            elif isinstance(child,cls.pair) and child.plain():
+                children.extend((child.a,child.b))
+            else:
+                children.append(child)
+        if len(children) < 3:
+            return node
+        nary = cls(*children,surface=node.surface,rounding=node.rounding)
+        nary.set_transform(node.rotate,node.translate)
+        return nary
+        
+class NaryUnion(NarySDF):
+    '''Defines a SDF for the union of any number of SDFs'''
+    
+    pair = Union
+    
+    def fn(self,pts):
+        return self.stack(pts).min(axis=0)
+        
+    def select(self,dists):
+        return np.argmin(dists,axis=0)
+        
+class NaryIntersection(NarySDF):
+    '''Defines a SDF for the intersection of any number of SDFs'''
+    
+    pair = Intersection
+    
+    def fn(self,pts):
+        return self.stack(pts).max(axis=0)
+        
+    def select(self,dists):
+        return np.argmax(dists,axis=0)
@@ -0,0 +1,621 @@
+#    Copyright 2022 by Benjamin J. Land (a.k.a. BenLand100)
+#
+#    This file is part of sdfray.
+#
+#    sdfray is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sdfray is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
+
+from .util import D_,dot
+import numpy as np
+import math
+import copy
+import types
+import warnings
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # Kernels still run (slowly) as plain Python, which keeps them testable
+    HAVE_NUMBA = False
+    def njit(*args,**kwargs):
+        return lambda fn: fn
+    prange = range
+    
+try:
+    from numba import cuda
+    HAVE_CUDA = HAVE_NUMBA and cuda.is_available()
+except ImportError:
+    HAVE_CUDA = False
+
+class NotCompilable(Exception):
+    '''An SDF tree contains a node that `SDF.compile` cannot flatten'''
+    
+class TooDeepToSpecialize(Exception):
+    '''An SDF tree is nested too deeply for `specialized_source` to unroll'''
+
+# Op-codes for the nodes of an SDF tree flattened by `SDF.compile`
+OP_SPHERE = 0
+OP_BOX = 1
+OP_CYLINDER = 2
+OP_PLANE = 3
+OP_UNION = 4
+OP_INTERSECTION = 5
+OP_SUBTRACTION = 6
+
+BLOCK = 256
+CUDA_MAX_NODES = 128 # size of the per-thread scratch space on the GPU
+CUDA_MIN_POINTS = 1<<16 # smaller batches are not worth the transfers
+FUSED_BLOCK = 1<<13 # points per call of a fused function, so its temporaries stay in cache
+
+@njit(fastmath=True,cache=True)
+def eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y,z,vals):
+    '''Evaluates a flattened SDF tree at one point, using vals as scratch space
+       for the value of each node. Nodes are in post-order, so children are 
+       always evaluated before their parents, and each (3,4) affine [R|T] is 
+       already composed into a world-to-local transform R@p-T. The right subtree
+       of a union is skipped when the distance to its bounding sphere already 
+       exceeds the left subtree.'''
+    nodes = ops.shape[0]
+    k = 0
+    while k < nodes:
+        b = skip[k]
+        if b >= 0:
+            # k starts the right subtree b of a union whose left child is k-1
+            bx,by,bz = x-bounds[b,0],y-bounds[b,1],z-bounds[b,2]
+            v = math.sqrt(bx*bx + by*by + bz*bz) - bounds[b,3]
+            if v >= vals[k-1]:
+                vals[b] = v
+                k = b+1
+                continue
+        op = ops[k]
+        if op == OP_UNION:
+            v = min(vals[lchild[k]],vals[rchild[k]])
+        elif op == OP_INTERSECTION:
+            v = max(vals[lchild[k]],vals[rchild[k]])
+        elif op == OP_SUBTRACTION:
+            v = max(vals[lchild[k]],-vals[rchild[k]])
+        else:
+            px = affine[k,0,0]*x + affine[k,0,1]*y + affine[k,0,2]*z - affine[k,0,3]
+            py = affine[k,1,0]*x + affine[k,1,1]*y + affine[k,1,2]*z - affine[k,1,3]
+            pz = affine[k,2,0]*x + affine[k,2,1]*y + affine[k,2,2]*z - affine[k,2,3]
+            if op == OP_SPHERE:
+                v = math.sqrt(px*px + py*py + pz*pz) - params[k,0]
+            elif op == OP_BOX:
+                dx = abs(px) - params[k,0]
+                dy = abs(py) - params[k,1]
+                dz = abs(pz) - params[k,2]
+                mx,my,mz = max(dx,0.),max(dy,0.),max(dz,0.)
+                v = math.sqrt(mx*mx + my*my + mz*mz) + min(max(dx,max(dy,dz)),0.)
+            elif op == OP_CYLINDER:
+                a = math.sqrt(px*px + pz*pz) - params[k,1]
+                c = abs(py) - params[k,0]
+                ma,mc = max(a,0.),max(c,0.)
+                v = min(max(a,c),0.) + math.sqrt(ma*ma + mc*mc)
+            else: # OP_PLANE
+                v = px*params[k,0] + py*params[k,1] + pz*params[k,2] - params[k,3]
+        vals[k] = v - rounding[k]
+        k += 1
+    return vals[nodes-1]
+
+@njit(parallel=True,fastmath=True,cache=True)
+def eval_tree(ops,lchild,rchild,params,affine,rounding,bounds,skip,pts,out):
+    '''Evaluates a flattened SDF tree at every point in one pass'''
+    n = pts.shape[0]
+    for b in prange((n+BLOCK-1)//BLOCK):
+        vals = np.empty(ops.shape[0],dtype=out.dtype)
+        for i in range(b*BLOCK,min(n,(b+1)*BLOCK)):
+            out[i] = eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,pts[i,0],pts[i,1],pts[i,2],vals)
+            
+@njit(fastmath=True,cache=True)
+def trace_ray(ops,lchild,rchild,params,affine,rounding,bounds,skip,sign,x,y,z,dx,dy,dz,world_res,world_max,max_steps,max_t,vals):
+    '''Sphere-marches one ray until it meets a surface it is moving into, or 
+       escapes the world (or travels past max_t), mirroring `render.next_surface` 
+       for the SDF scaled by sign. Returns (hit,x,y,z,gx,gy,gz) with the gradient 
+       at the hit.'''
+    t = 0.
+    for step in range(max_steps):
+        sd = sign*eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y,z,vals)
+        if sd < 0:
+            sd = -sd + world_res
+        if sd < world_res:
+            gx = sign*(eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x+D_,y,z,vals)
+                     - eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x-D_,y,z,vals))
+            gy = sign*(eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y+D_,z,vals)
+                     - eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y-D_,z,vals))
+            gz = sign*(eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y,z+D_,vals)
+                     - eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y,z-D_,vals))
+            if gx*dx + gy*dy + gz*dz < 0:
+                return True,x,y,z,gx/(2*D_),gy/(2*D_),gz/(2*D_)
+            sd = world_res # leaving the surface; a float32 step of ~0 would never get away
+        if x*x + y*y + z*z > world_max*world_max or t > max_t:
+            break
+        t += sd
+        x += dx*sd
+        y += dy*sd
+        z += dz*sd
+    return False,x,y,z,0.,0.,0.
+
+@njit(parallel=True,fastmath=True,cache=True)
+def surface_trace(ops,lchild,rchild,params,affine,rounding,bounds,skip,sign,origins,dirs,world_res,world_max,max_steps,max_t,out_p,out_g,hit):
+    '''Marches each ray to its next surface, or at most max_t[i] along it, 
+       recording where it stopped and the gradient there'''
+    n = origins.shape[0]
+    for b in prange((n+BLOCK-1)//BLOCK):
+        vals = np.empty(ops.shape[0],dtype=origins.dtype)
+        for i in range(b*BLOCK,min(n,(b+1)*BLOCK)):
+            h,x,y,z,gx,gy,gz = trace_ray(ops,lchild,rchild,params,affine,rounding,bounds,skip,sign,
+                                         origins[i,0],origins[i,1],origins[i,2],dirs[i,0],dirs[i,1],dirs[i,2],
+                                         world_res,world_max,max_steps,max_t[i],vals)
+            hit[i] = h
+            out_p[i,0],out_p[i,1],out_p[i,2] = x,y,z
+            out_g[i,0],out_g[i,1],out_g[i,2] = gx,gy,gz
+            
+@njit(parallel=True,fastmath=True,cache=True)
+def shadow_trace(ops,lchild,rchild,params,affine,rounding,bounds,skip,origins,dirs,world_res,world_max,max_steps,max_t,blocked):
+    '''Marches each ray only to learn whether it is blocked by a surface within 
+       max_t[i] along it'''
+    n = origins.shape[0]
+    for b in prange((n+BLOCK-1)//BLOCK):
+        vals = np.empty(ops.shape[0],dtype=origins.dtype)
+        for i in range(b*BLOCK,min(n,(b+1)*BLOCK)):
+            blocked[i] = trace_ray(ops,lchild,rchild,params,affine,rounding,bounds,skip,1.,
+                                   origins[i,0],origins[i,1],origins[i,2],dirs[i,0],dirs[i,1],dirs[i,2],
+                                   world_res,world_max,max_steps,max_t[i],vals)[0]
+
+@njit(fastmath=True,cache=True)
+def transmit_ray(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y,z,dx,dy,dz,nx,ny,nz,nr,world_res,world_max,max_steps,max_bounces,vals):
+    '''Refracts one ray into a transparent surface with normal n and follows it 
+       through the interior, with total internal reflections, to where it leaves, 
+       mirroring `render.resolve_transmission`. Returns (escaped,x,y,z,dx,dy,dz);
+       rays still inside after max_bounces are not escaped.'''
+    for bounce in range(max_bounces+1):
+        if bounce > 0:
+            hit,x,y,z,nx,ny,nz = trace_ray(ops,lchild,rchild,params,affine,rounding,bounds,skip,-1.,
+                                           x,y,z,dx,dy,dz,world_res,world_max,max_steps,np.inf,vals)
+            if not hit:
+                break
+            norm = math.sqrt(nx*nx + ny*ny + nz*nz)
+            nx,ny,nz = nx/norm,ny/norm,nz/norm
+        # perpendicular component of the direction, d x n
+        px,py,pz = dy*nz - dz*ny, dz*nx - dx*nz, dx*ny - dy*nx
+        internal = nr*nr*(px*px + py*py + pz*pz)
+        if internal <= 1:
+            # refract through the surface: nr*(n x perp) - n*sqrt(1-internal)
+            c = math.sqrt(1-internal)
+            dx,dy,dz = (nr*(ny*pz - nz*py) - nx*c, nr*(nz*px - nx*pz) - ny*c, nr*(nx*py - ny*px) - nz*c)
+            if bounce > 0:
+                break
+            nr = 1/nr
+        else:
+            # total internal reflection
+            dot = 2*(dx*nx + dy*ny + dz*nz)
+            dx,dy,dz = dx - dot*nx, dy - dot*ny, dz - dot*nz
+            norm = math.sqrt(dx*dx + dy*dy + dz*dz)
+            dx,dy,dz = dx/norm,dy/norm,dz/norm
+            if bounce == 0:
+                break # reflected off the outside
+    else:
+        return False,x,y,z,dx,dy,dz
+    return True,x,y,z,dx,dy,dz
+
+@njit(parallel=True,fastmath=True,cache=True)
+def transmit_trace(ops,lchild,rchild,params,affine,rounding,bounds,skip,origins,dirs,normals,nratio,world_res,world_max,max_steps,max_bounces,out_p,out_d,escaped):
+    '''Follows each ray through a transparent shape, as in `transmit_ray`'''
+    n = origins.shape[0]
+    for b in prange((n+BLOCK-1)//BLOCK):
+        vals = np.empty(ops.shape[0],dtype=origins.dtype)
+        for i in range(b*BLOCK,min(n,(b+1)*BLOCK)):
+            e,x,y,z,dx,dy,dz = transmit_ray(ops,lchild,rchild,params,affine,rounding,bounds,skip,
+                                            origins[i,0],origins[i,1],origins[i,2],dirs[i,0],dirs[i,1],dirs[i,2],
+                                            normals[i,0],normals[i,1],normals[i,2],nratio[i],
+                                            world_res,world_max,max_steps,max_bounces,vals)
+            escaped[i] = e
+            out_p[i,0],out_p[i,1],out_p[i,2] = x,y,z
+            out_d[i,0],out_d[i,1],out_d[i,2] = dx,dy,dz
+
+@njit(parallel=True,fastmath=True,cache=True)
+def shade_visible(norms,out_d,light_c,surf_c,idx,colors):
+    '''Accumulates the light reflected by each visible point into colors[idx]'''
+    for i in prange(idx.shape[0]):
+        cosa = out_d[i,0]*norms[i,0] + out_d[i,1]*norms[i,1] + out_d[i,2]*norms[i,2]
+        k = idx[i]
+        for c in range(3):
+            colors[k,c] += light_c[i,c]*surf_c[i,c]*cosa
+
+@njit(fastmath=True,cache=True)
+def perlin_corner(lattice_vecs,k,x,y,z):
+    '''Contribution of lattice point k: its gradient dotted with the offset x,y,z to it'''
+    return lattice_vecs[k,0]*x + lattice_vecs[k,1]*y + lattice_vecs[k,2]*z
+
+@njit(fastmath=True,cache=True)
+def perlin_blend(a,b,frac):
+    return (b - a) * (3.0 - frac * 2.0) * frac * frac + a
+
+@njit(fastmath=True,cache=True)
+def perlin_point(lattice_vecs,length_scale,feature_count,x,y,z):
+    '''Evaluates `surface.PerlinSurface` noise at one point, blending the eight
+       corners of the enclosing lattice cell along x, y, then z. The lattice 
+       repeats every length_scale with feature_count cells along each axis, and 
+       point (i,j,k) along (x,y,z) is at flat index i+F*j+F*F*k.'''
+    F = feature_count
+    spacing = length_scale/F
+    lx,ly,lz = (x % length_scale)/spacing,(y % length_scale)/spacing,(z % length_scale)/spacing
+    ix,iy,iz = min(int(lx),F-1),min(int(ly),F-1),min(int(lz),F-1)
+    fx,fy,fz = lx-ix,ly-iy,lz-iz
+    # flat index contributions of the near and (wrapped) far corners on each axis
+    i0,i1 = ix,(ix+1) % F
+    j0,j1 = iy*F,((iy+1) % F)*F
+    k0,k1 = iz*F*F,((iz+1) % F)*F*F
+    x0,y0,z0 = fx,fy,fz # offsets in units of cells
+    x1,y1,z1 = fx-1,fy-1,fz-1
+    v = perlin_blend(
+        perlin_blend(
+            perlin_blend(perlin_corner(lattice_vecs,i0+j0+k0,x0,y0,z0),
+                         perlin_corner(lattice_vecs,i1+j0+k0,x1,y0,z0),fx),
+            perlin_blend(perlin_corner(lattice_vecs,i0+j1+k0,x0,y1,z0),
+                         perlin_corner(lattice_vecs,i1+j1+k0,x1,y1,z0),fx),fy),
+        perlin_blend(
+            perlin_blend(perlin_corner(lattice_vecs,i0+j0+k1,x0,y0,z1),
+                         perlin_corner(lattice_vecs,i1+j0+k1,x1,y0,z1),fx),
+            perlin_blend(perlin_corner(lattice_vecs,i0+j1+k1,x0,y1,z1),
+                         perlin_corner(lattice_vecs,i1+j1+k1,x1,y1,z1),fx),fy),fz)
+    return max(v/4/math.sqrt(2)+0.5,0)*0.5+0.5
+
+@njit(parallel=True,fastmath=True,cache=True)
+def perlin_noise(pts,lattice_vecs,length_scale,feature_count,out):
+    '''Evaluates `perlin_point` at each point in one pass'''
+    for i in prange(pts.shape[0]):
+        out[i] = perlin_point(lattice_vecs,length_scale,feature_count,pts[i,0],pts[i,1],pts[i,2])
+
+@njit(parallel=True,fastmath=True,cache=True)
+def cube_map_pixels(pts,face_axes,face_offsets,out):
+    '''Projects each point onto the cube of half-width 512, clamped to it, and
+       finds the (column,row) of the `surface.SphereCubeMap` texel it lands on, 
+       in one pass. Faces are numbered 2*axis+(coordinate along axis > 0).'''
+    for i in prange(pts.shape[0]):
+        x,y,z = pts[i,0],pts[i,1],pts[i,2]
+        ax,ay,az = abs(x),abs(y),abs(z)
+        scale = 512*math.sqrt(x*x + y*y + z*z)/max(ax,ay,az)
+        c = (min(max(x*scale,-512.),512.),min(max(y*scale,-512.),512.),min(max(z*scale,-512.),512.))
+        axis = 0
+        if abs(c[1]) > abs(c[axis]):
+            axis = 1
+        if abs(c[2]) > abs(c[axis]):
+            axis = 2
+        face = 2*axis + (1 if c[axis] > 0 else 0)
+        out[i,0] = int(math.floor(c[face_axes[face,0]] + face_offsets[face,0] + 512))
+        out[i,1] = int(math.floor(c[face_axes[face,1]] + face_offsets[face,1] + 512))
+
+@njit(parallel=True,cache=True) # no fastmath: points on square edges must round as in numpy
+def checker_squares(pts,a_v,b_v,size,out):
+    '''True where the square containing each point, counted along a_v and b_v,
+       has the same parity along both, as in `surface.CheckerSurface.checks`'''
+    for i in prange(pts.shape[0]):
+        a_c = pts[i,0]*a_v[0] + pts[i,1]*a_v[1] + pts[i,2]*a_v[2]
+        b_c = pts[i,0]*b_v[0] + pts[i,1]*b_v[1] + pts[i,2]*b_v[2]
+        out[i] = ((int(math.floor(a_c/size)) ^ int(math.floor(b_c/size))) & 1) == 0
+
+def rebind(kernel,**fns):
+    '''The Python function behind a kernel, calling the given functions in place 
+       of the kernels they name'''
+    fn = kernel.py_func
+    return types.FunctionType(fn.__code__,{**fn.__globals__,**fns},fn.__name__,fn.__defaults__,fn.__closure__)
+
+def specialized_source(ops,lchild,rchild,skip):
+    '''Generates the source of an `eval_point` specialized to the topology of one
+       flattened SDF tree. The loop over nodes is unrolled into straight-line code,
+       with the right subtree of each bounded union nested under its bounding 
+       sphere test. Parameters, transforms, and bounds are still read from the 
+       arrays, so new Parameter values do not need new code.'''
+    lines = ['def eval_point(ops,lchild,rchild,params,affine,rounding,bounds,skip,x,y,z,vals):']
+    bounded = {b for b in skip if b >= 0}
+    combine = {OP_UNION:'min(v{0},v{1})',OP_INTERSECTION:'max(v{0},v{1})',OP_SUBTRACTION:'max(v{0},-v{1})'}
+    def emit(k,pad):
+        if len(pad) > 320: # python allows at most 100 levels of indentation
+            raise TooDeepToSpecialize('SDF tree is too deep to specialize')
+        op = ops[k]
+        if op in combine:
+            l,r = lchild[k],rchild[k]
+            emit(l,pad)
+            if r in bounded:
+                # as in eval_point, the right subtree can't win the union if its bound is beyond the left
+                lines.append(f'{pad}bx,by,bz = x-bounds[{r},0],y-bounds[{r},1],z-bounds[{r},2]')
+                lines.append(f'{pad}if math.sqrt(bx*bx + by*by + bz*bz) - bounds[{r},3] < v{l}:')
+                emit(r,pad+'    ')
+                lines.append(f'{pad}    v{k} = {combine[op].format(l,r)} - rounding[{k}]')
+                lines.append(f'{pad}else:')
+                lines.append(f'{pad}    v{k} = v{l} - rounding[{k}]')
+            else:
+                emit(r,pad)
+                lines.append(f'{pad}v{k} = {combine[op].format(l,r)} - rounding[{k}]')
+            return
+        lines.extend(f'{pad}p{c} = affine[{k},{i},0]*x + affine[{k},{i},1]*y + affine[{k},{i},2]*z - affine[{k},{i},3]' for i,c in enumerate('xyz'))
+        if op == OP_SPHERE:
+            lines.append(f'{pad}v{k} = math.sqrt(px*px + py*py + pz*pz) - params[{k},0] - rounding[{k}]')
+        elif op == OP_BOX:
+            lines.append(f'{pad}dx,dy,dz = abs(px) - params[{k},0],abs(py) - params[{k},1],abs(pz) - params[{k},2]')
+            lines.append(f'{pad}mx,my,mz = max(dx,0.),max(dy,0.),max(dz,0.)')
+            lines.append(f'{pad}v{k} = math.sqrt(mx*mx + my*my + mz*mz) + min(max(dx,max(dy,dz)),0.) - rounding[{k}]')
+        elif op == OP_CYLINDER:
+            lines.append(f'{pad}a,c = math.sqrt(px*px + pz*pz) - params[{k},1],abs(py) - params[{k},0]')
+            lines.append(f'{pad}ma,mc = max(a,0.),max(c,0.)')
+            lines.append(f'{pad}v{k} = min(max(a,c),0.) + math.sqrt(ma*ma + mc*mc) - rounding[{k}]')
+        else: # OP_PLANE
+            lines.append(f'{pad}v{k} = px*params[{k},0] + py*params[{k},1] + pz*params[{k},2] - params[{k},3] - rounding[{k}]')
+    emit(len(ops)-1,'    ')
+    lines.append(f'    return v{len(ops)-1}')
+    return '\n'.join(lines)
+
+specialized = {} # kernels for each tree topology, as returned by specialize_kernels
+
+def specialize_kernels(ops,lchild,rchild,skip):
+    '''The kernels used by `CompiledSDF`, recompiled around an `eval_point` 
+       generated for one tree topology (see `specialized_source`). These are
+       cached per topology, but compiling them takes a few seconds.'''
+    key = (ops.tobytes(),lchild.tobytes(),rchild.tobytes(),skip.tobytes())
+    if key not in specialized:
+        scope = {'math':math}
+        exec(compile(specialized_source(ops,lchild,rchild,skip),'<specialized sdf>','exec'),scope)
+        point = njit(fastmath=True)(scope['eval_point'])
+        ray = njit(fastmath=True)(rebind(trace_ray,eval_point=point))
+        specialized[key] = types.SimpleNamespace(
+            eval_tree=njit(parallel=True,fastmath=True)(rebind(eval_tree,eval_point=point)),
+            surface_trace=njit(parallel=True,fastmath=True)(rebind(surface_trace,trace_ray=ray)),
+            shadow_trace=njit(parallel=True,fastmath=True)(rebind(shadow_trace,trace_ray=ray)),
+            transmit_trace=njit(parallel=True,fastmath=True)(rebind(transmit_trace,transmit_ray=njit(fastmath=True)(rebind(transmit_ray,trace_ray=ray)))))
+    return specialized[key]
+
+generic = types.SimpleNamespace(eval_tree=eval_tree,surface_trace=surface_trace,shadow_trace=shadow_trace,transmit_trace=transmit_trace)
+
+if HAVE_CUDA:
+    def on_device(kernel,**device_fns):
+        '''Compiles the Python source of a CPU kernel as a CUDA device function,
+           calling the given device functions in place of the CPU kernels they name'''
+        return cuda.jit(device=True)(rebind(kernel,**device_fns))
+        
+    eval_point_cuda = on_device(eval_point)
+    trace_ray_cuda = on_device(trace_ray,eval_point=eval_point_cuda)
+    transmit_ray_cuda = on_device(transmit_ray,trace_ray=trace_ray_cuda)
+    perlin_point_cuda = on_device(perlin_point,perlin_corner=on_device(perlin_corner),perlin_blend=on_device(perlin_blend))
+    
+    @cuda.jit
+    def eval_tree_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,pts,out):
+        '''Evaluates a flattened SDF tree with one GPU thread per point'''
+        i = cuda.grid(1)
+        if i < pts.shape[0]:
+            vals = cuda.local.array(CUDA_MAX_NODES,np.float32)
+            out[i] = eval_point_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,pts[i,0],pts[i,1],pts[i,2],vals)
+
+    @cuda.jit
+    def surface_trace_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,sign,origins,dirs,world_res,world_max,max_steps,max_t,out_p,out_g,hit):
+        '''`surface_trace` with one GPU thread per ray'''
+        i = cuda.grid(1)
+        if i < origins.shape[0]:
+            vals = cuda.local.array(CUDA_MAX_NODES,np.float32)
+            h,x,y,z,gx,gy,gz = trace_ray_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,sign,
+                                              origins[i,0],origins[i,1],origins[i,2],dirs[i,0],dirs[i,1],dirs[i,2],
+                                              world_res,world_max,max_steps,max_t[i],vals)
+            hit[i] = h
+            out_p[i,0],out_p[i,1],out_p[i,2] = x,y,z
+            out_g[i,0],out_g[i,1],out_g[i,2] = gx,gy,gz
+            
+    @cuda.jit
+    def shadow_trace_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,origins,dirs,world_res,world_max,max_steps,max_t,blocked):
+        '''`shadow_trace` with one GPU thread per ray'''
+        i = cuda.grid(1)
+        if i < origins.shape[0]:
+            vals = cuda.local.array(CUDA_MAX_NODES,np.float32)
+            blocked[i] = trace_ray_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,1.,
+                                        origins[i,0],origins[i,1],origins[i,2],dirs[i,0],dirs[i,1],dirs[i,2],
+                                        world_res,world_max,max_steps,max_t[i],vals)[0]
+
+    @cuda.jit
+    def transmit_trace_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,origins,dirs,normals,nratio,world_res,world_max,max_steps,max_bounces,out_p,out_d,escaped):
+        '''`transmit_trace` with one GPU thread per ray'''
+        i = cuda.grid(1)
+        if i < origins.shape[0]:
+            vals = cuda.local.array(CUDA_MAX_NODES,np.float32)
+            e,x,y,z,dx,dy,dz = transmit_ray_cuda(ops,lchild,rchild,params,affine,rounding,bounds,skip,
+                                                 origins[i,0],origins[i,1],origins[i,2],dirs[i,0],dirs[i,1],dirs[i,2],
+                                                 normals[i,0],normals[i,1],normals[i,2],nratio[i],
+                                                 world_res,world_max,max_steps,max_bounces,vals)
+            escaped[i] = e
+            out_p[i,0],out_p[i,1],out_p[i,2] = x,y,z
+            out_d[i,0],out_d[i,1],out_d[i,2] = dx,dy,dz
+
+    @cuda.jit
+    def perlin_noise_cuda(pts,lattice_vecs,length_scale,feature_count,out):
+        '''`perlin_noise` with one GPU thread per point'''
+        i = cuda.grid(1)
+        if i < pts.shape[0]:
+            out[i] = perlin_point_cuda(lattice_vecs,length_scale,feature_count,pts[i,0],pts[i,1],pts[i,2])
+
+def fused_source(ops,lchild,rchild,params,affine,rounding,bounds,skip):
+    '''Generates the source of a numpy function `fused(pts)` evaluating a 
+       flattened SDF tree with every constant inlined, mirroring `eval_point`'''
+    f = lambda v: repr(float(v))
+    shift = lambda var,v: var if v == 0 else f'{var}-{f(v)}' if v > 0 else f'{var}+{f(-v)}'
+    lines = ['def fused(pts):','    x,y,z = np.ascontiguousarray(pts.T) # contiguous coordinate streams']
+    for k,op in enumerate(ops):
+        if op == OP_UNION:
+            expr = f'np.minimum(v{lchild[k]},v{rchild[k]})'
+        elif op == OP_INTERSECTION:
+            expr = f'np.maximum(v{lchild[k]},v{rchild[k]})'
+        elif op == OP_SUBTRACTION:
+            expr = f'np.maximum(v{lchild[k]},-v{rchild[k]})'
+        else:
+            R,T = affine[k,:,:3],affine[k,:,3]
+            if np.array_equal(R,np.eye(3)):
+                lines.append(f'    px,py,pz = {shift("x",T[0])},{shift("y",T[1])},{shift("z",T[2])}')
+            else:
+                lines.append('    px,py,pz = '+','.join(shift(f'{f(R[i,0])}*x+{f(R[i,1])}*y+{f(R[i,2])}*z',T[i]) for i in range(3)))
+            a,b,c,d = [f(v) for v in params[k]]
+            if op == OP_SPHERE:
+                expr = f'np.sqrt(px*px+py*py+pz*pz)-{a}'
+            elif op == OP_BOX:
+                lines.append(f'    dx,dy,dz = np.abs(px)-{a},np.abs(py)-{b},np.abs(pz)-{c}')
+                lines.append(f'    mx,my,mz = np.maximum(dx,0.),np.maximum(dy,0.),np.maximum(dz,0.)')
+                expr = 'np.sqrt(mx*mx+my*my+mz*mz)+np.minimum(np.maximum(dx,np.maximum(dy,dz)),0.)'
+            elif op == OP_CYLINDER:
+                lines.append(f'    a,c = np.sqrt(px*px+pz*pz)-{b},np.abs(py)-{a}')
+                lines.append(f'    ma,mc = np.maximum(a,0.),np.maximum(c,0.)')
+                expr = 'np.minimum(np.maximum(a,c),0.)+np.sqrt(ma*ma+mc*mc)'
+            else: # OP_PLANE
+                expr = f'px*{a}+py*{b}+pz*{c}-{d}'
+        if rounding[k] != 0:
+            expr = f'{expr}-{f(rounding[k])}'
+        lines.append(f'    v{k} = {expr}')
+    lines.append(f'    return v{len(ops)-1}')
+    return '\n'.join(lines)
+
+class FusedSDF:
+    '''Stands in for an SDF tree during CPU rendering without numba: distances 
+       are computed by one generated numpy function (see `fused_source`) instead 
+       of walking the tree, while surface properties defer to the original tree.'''
+       
+    def __init__(self,sdf):
+        self.sdf = sdf
+        self.refresh()
+        
+    def refresh(self):
+        '''Regenerates the function with the current values of any Parameters'''
+        self.source = fused_source(*self.sdf.compile())
+        scope = {'np':np}
+        exec(compile(self.source,'<fused sdf>','exec'),scope)
+        self.fused = scope['fused']
+        
+    def __call__(self,pts,properties=False):
+        return self.properties(pts) if properties else self.distance(pts)
+        
+    def properties(self,pts):
+        return self.sdf.properties(pts)
+        
+    def distance(self,pts):
+        pts = np.asarray(pts)
+        if len(pts) <= FUSED_BLOCK:
+            return self.fused(pts)
+        out = np.empty(len(pts),dtype=pts.dtype)
+        for i in range(0,len(pts),FUSED_BLOCK):
+            out[i:i+FUSED_BLOCK] = self.fused(pts[i:i+FUSED_BLOCK])
+        return out
+
+def travel_limit(origins,dirs,stop_at):
+    '''How far along each (unit) direction a ray may travel before passing stop_at'''
+    if stop_at is None:
+        return np.full(len(origins),np.inf,dtype=origins.dtype)
+    return np.ascontiguousarray(dot(stop_at-origins,dirs),dtype=origins.dtype)
+
+class CompiledSDF:
+    '''Stands in for an SDF tree during CPU rendering: distances are computed by
+       the `eval_tree` kernel, while surface properties defer to the original tree.
+       Large batches of distances, surface marches, shadow rays, and transmissions
+       run on the GPU when CUDA is available. With specialize, the CPU kernels are 
+       compiled for this tree's topology (see `specialize_kernels`), which pays off 
+       for long renders.'''
+
+    def __init__(self,sdf,specialize=False):
+        self.sdf = sdf
+        self.sign = 1.
+        self.tree = sdf.compile()
+        self.kernels = generic
+        if specialize:
+            ops,lchild,rchild,params,affine,rounding,bounds,skip = self.tree
+            try:
+                self.kernels = specialize_kernels(ops,lchild,rchild,skip)
+            except TooDeepToSpecialize:
+                pass #the generic kernels handle any tree
+            except Exception as e:
+                warnings.warn(f'Using the generic kernels, specialization failed: {e!r}')
+        self.device_tree = None
+        if HAVE_CUDA and len(self.tree[0]) <= CUDA_MAX_NODES:
+            self.device_tree = tuple(cuda.to_device(a) for a in self.tree)
+
+    def refresh(self):
+        '''Re-evaluates the Parameters in the tree with their current values. The 
+           topology of a tree never changes, so the kernels and layout are reused.'''
+        self.tree = self.sdf.compile()
+        if self.device_tree is not None:
+            self.device_tree = tuple(cuda.to_device(a) for a in self.tree)
+
+    def __call__(self,pts,properties=False):
+        return self.properties(pts) if properties else self.distance(pts)
+        
+    def properties(self,pts):
+        return self.sdf.properties(pts)
+        
+    def distance(self,pts):
+        pts = np.ascontiguousarray(pts)
+        if self.device_tree is not None and len(pts) >= CUDA_MIN_POINTS:
+            out = cuda.device_array(len(pts),dtype=pts.dtype)
+            eval_tree_cuda[(len(pts)+BLOCK-1)//BLOCK,BLOCK](*self.device_tree,cuda.to_device(pts),out)
+            out = out.copy_to_host()
+        else:
+            out = np.empty(len(pts),dtype=pts.dtype)
+            self.kernels.eval_tree(*self.tree,pts,out)
+        return out if self.sign > 0 else np.negative(out,out=out)
+        
+    def negated(self):
+        '''This SDF with its inside and outside swapped, for marching through interiors'''
+        neg = copy.copy(self)
+        neg.sign = -self.sign
+        return neg
+        
+    def transmit(self,p,in_d,n,nratio,world_res,world_max,max_steps,max_bounces):
+        '''Where and in what direction each ray leaves the interior of a 
+           transparent shape, and whether it did, as in `render.resolve_transmission`'''
+        origins = np.ascontiguousarray(p)
+        args = (origins,np.ascontiguousarray(in_d,dtype=origins.dtype),
+                np.ascontiguousarray(n,dtype=origins.dtype),np.ascontiguousarray(nratio,dtype=origins.dtype))
+        if self.device_tree is not None and len(origins) >= CUDA_MIN_POINTS:
+            out_p,out_d = cuda.device_array_like(origins),cuda.device_array_like(origins)
+            escaped = cuda.device_array(len(origins),dtype=bool)
+            transmit_trace_cuda[(len(origins)+BLOCK-1)//BLOCK,BLOCK](*self.device_tree,*[cuda.to_device(a) for a in args],
+                                                                   world_res,world_max,max_steps,max_bounces,out_p,out_d,escaped)
+            return out_p.copy_to_host(),out_d.copy_to_host(),escaped.copy_to_host()
+        out_p,out_d = np.empty_like(origins),np.empty_like(origins)
+        escaped = np.empty(len(origins),dtype=bool)
+        self.kernels.transmit_trace(*self.tree,*args,world_res,world_max,max_steps,max_bounces,out_p,out_d,escaped)
+        return out_p,out_d,escaped
+        
+    def march(self,rays,world_res,world_max,max_steps,stop_at=None):
+        '''For each ray, the position and gradient of the next surface, and 
+           whether one was found, as returned by `render.next_surface`'''
+        origins = np.ascontiguousarray(rays.p)
+        dirs = np.ascontiguousarray(rays.d,dtype=origins.dtype)
+        max_t = travel_limit(origins,dirs,stop_at)
+        if self.device_tree is not None and len(origins) >= CUDA_MIN_POINTS:
+            p,g = cuda.device_array_like(origins),cuda.device_array_like(origins)
+            hit = cuda.device_array(len(origins),dtype=bool)
+            surface_trace_cuda[(len(origins)+BLOCK-1)//BLOCK,BLOCK](*self.device_tree,self.sign,cuda.to_device(origins),cuda.to_device(dirs),
+                                                                  world_res,world_max,max_steps,cuda.to_device(max_t),p,g,hit)
+            return p.copy_to_host(),g.copy_to_host(),hit.copy_to_host()
+        p,g = np.empty_like(origins),np.empty_like(origins)
+        hit = np.empty(len(origins),dtype=bool)
+        self.kernels.surface_trace(*self.tree,self.sign,origins,dirs,world_res,world_max,max_steps,max_t,p,g,hit)
+        return p,g,hit
+        
+    def blocked(self,rays,world_res,world_max,max_steps,stop_at=None):
+        '''For each ray, whether it is blocked by a surface before escaping (or 
+           before passing stop_at)'''
+        origins = np.ascontiguousarray(rays.p)
+        dirs = np.ascontiguousarray(rays.d,dtype=origins.dtype)
+        max_t = travel_limit(origins,dirs,stop_at)
+        if self.device_tree is not None and len(origins) >= CUDA_MIN_POINTS:
+            blocked = cuda.device_array(len(origins),dtype=bool)
+            shadow_trace_cuda[(len(origins)+BLOCK-1)//BLOCK,BLOCK](*self.device_tree,cuda.to_device(origins),cuda.to_device(dirs),
+                                                                 world_res,world_max,max_steps,cuda.to_device(max_t),blocked)
+            return blocked.copy_to_host()
+        blocked = np.empty(len(origins),dtype=bool)
+        self.kernels.shadow_trace(*self.tree,origins,dirs,world_res,world_max,max_steps,max_t,blocked)
+        return blocked
@@ -17,13 +17,23 @@
 
 from .util import *
 from .render import *
+from .jit import HAVE_NUMBA,CompiledSDF,shade_visible
 import numpy as np
 
+def blocked(rays,sdf,stop_at=None):
+    '''For each ray, whether the SDF blocks it before it escapes (or passes stop_at)'''
+    if isinstance(sdf,CompiledSDF):
+        return sdf.blocked(rays,WORLD_RES,WORLD_MAX,MAX_STEPS,stop_at)
+    _,_,blocked = next_surface(rays,sdf,stop_at=stop_at,lighting=True)
+    return blocked
+
 class Light:
     '''Base class for implenting lighting effects. Implements lighting surfaces
        based on orientation to an illumination direction (or ambient, with no 
        orientation).'''
 
+    pre_normalized = False # True if pointing returns unit vectors
+    
     def __init__(self):
         pass
         
@@ -35,51 +45,109 @@ class Light:
         '''Should return the color of the source given an angle of incidence'''
         raise Exception('Use a Light implementation, instead!')
         
-    def light(self,pts,surfaces,in_dirs,normals,sdf,colors=None,lights=[],prescale=None):
+    def illumination(self,pts,pointing):
+        '''Should return the (N,3) color arriving at pts, or a single (3,) 
+           color if it is the same everywhere'''
+        raise Exception('Use a Light implementation, instead!')
+        
+    def stop_at(self,pts):
+        '''Where shadow rays from pts reach the source, or None if they must escape'''
+        return None
+        
+    def light(self,pts,surf_colors,in_dirs,normals,sdf,colors=None,lights=[],prescale=None):
         '''Checks to see if the light is not occluded, and if not, calculates 
-           the light reflected from that surface'''
+           the light reflected from that surface. surf_colors holds the (N,3) 
+           colors of the surfaces at pts'''
         #print('Lighting',self)
         if colors is None:
             colors = np.zeros(pts.shape,dtype=np.float32)
         pointing = self.pointing(pts)
         if pointing is None:
             light_colors = self.illumination(pts,None)
-            surf_colors = A([s.color for s in surfaces])
             colors += (light_colors*surf_colors)
         else:
-            lr = Rays(p=pts,d=N(pointing))
+            lr = Rays(p=pts,d=pointing if self.pre_normalized else N(pointing))
             #print('Calculating visibility')
-            _,_,lr_blocked = next_surface(lr,sdf,lighting=True)
-            m = ~lr_blocked #point has visibility to light source
-        
-            if np.count_nonzero(m):
-                norms = normals[m]
-                in_d = in_dirs[m]
-                out_d = lr.d[m]
-                p_illum = lr.p[m]
-                light_colors = self.illumination(p_illum,pointing[m])
-                surfs = surfaces[m]
-                surf_colors = A([s.color for s in surfs])
+            m = ~blocked(lr,sdf,self.stop_at(pts)) #point has visibility to light source
+        
+            if m.any():
+                idx = np.flatnonzero(m) #gather each array once by index, not by mask
+                norms = np.take(normals,idx,axis=0)
+                out_d = np.take(lr.d,idx,axis=0)
+                p_illum = np.take(lr.p,idx,axis=0)
+                light_colors = self.illumination(p_illum,np.take(pointing,idx,axis=0))
+                surf_c = np.take(surf_colors,idx,axis=0)
                 
-                out_d_dot_normal = np.sum(out_d*norms,axis=-1)
-                colors[m] += ((light_colors*surf_colors).T*out_d_dot_normal).T
+                if HAVE_NUMBA:
+                    light_colors = np.broadcast_to(light_colors,surf_c.shape)
+                    shade_visible(norms,out_d,light_colors,surf_c,idx,colors)
+                else:
+                    out_d_dot_normal = dot(out_d,norms)
+                    colors[idx] += light_colors*surf_c*out_d_dot_normal[:,None]
             
         return colors
         
     def glsl(self):
         raise Exception(f'{type(self)} does not implement glsl')
 
+class LightGroup(Light):
+    '''Several lights acting as one, so that the shadow rays toward every 
+       directional light are traced as a single batch'''
+       
+    def __init__(self,lights):
+        self.lights = list(lights)
+        
+    def light(self,pts,surf_colors,in_dirs,normals,sdf,colors=None,lights=[],prescale=None):
+        if colors is None:
+            colors = np.zeros(pts.shape,dtype=np.float32)
+        directed = []
+        for li in self.lights:
+            pointing = li.pointing(pts)
+            if pointing is None:
+                colors += li.illumination(pts,None)*surf_colors
+            else:
+                directed.append((li,pointing))
+        if len(directed) == 0:
+            return colors
+            
+        n = len(pts)
+        pointing = np.concatenate([pointing for li,pointing in directed])
+        dirs = np.concatenate([pointing if li.pre_normalized else N(pointing) for li,pointing in directed])
+        # pts broadcast against each light's directions, straight into the rays' buffer
+        lr = Rays(p=pts,d=dirs.reshape(len(directed),n,3))
+        lr = Rays(buf=lr.buf.reshape(-1,6))
+        stops = [li.stop_at(pts) for li,_ in directed]
+        if all(stop is None for stop in stops):
+            stop_at = None
+        else: # rays toward lights without a stop are stopped past the edge of the world
+            stop_at = np.concatenate([np.broadcast_to(stop,pts.shape) if stop is not None else pts+2*WORLD_MAX*d 
+                                      for stop,d in zip(stops,np.split(dirs,len(directed)))])
+        idx = np.flatnonzero(~blocked(lr,sdf,stop_at)) # shadow ray i is point i%n toward light i//n
+        if len(idx) == 0:
+            return colors
+            
+        splits = np.searchsorted(idx,np.arange(1,len(directed))*n)
+        light_colors = np.concatenate([np.broadcast_to(li.illumination(np.take(lr.p,i,axis=0),np.take(pointing,i,axis=0)),(len(i),3)) 
+                                       for (li,_),i in zip(directed,np.split(idx,splits))])
+        pt_idx = idx % n
+        out_d_dot_normal = dot(np.take(lr.d,idx,axis=0),np.take(normals,pt_idx,axis=0))
+        np.add.at(colors,pt_idx,light_colors*np.take(surf_colors,pt_idx,axis=0)*out_d_dot_normal[:,None])
+        return colors
+        
+    def glsl(self):
+        raise Exception('LightGroup is only for CPU rendering; use its lights for glsl')
+
 class AmbientLight(Light):
     '''A light that is _everywhere_'''
 
     def __init__(self,color):
-        self.color = A(color)
+        self.color = A(color,np.float32)
         
     def pointing(self,pts):
         return None
         
     def illumination(self,pts,pointing):
-        return np.tile(self.color,(len(pts),1))
+        return self.color
         
     def glsl(self):
         return glsl_vec3(self.color),[]
@@ -88,14 +156,17 @@ class DistantLight(Light):
     '''A light that is far from the scene, and comes from a particular direction'''
 
     def __init__(self,color,direction):
-        self.color = A(color)
-        self.direction = A(direction)
+        self.color = A(color,np.float32)
+        self.direction = A(direction,np.float32)
+        if self.direction.dtype != object: # Parameters must stay symbolic
+            self.direction /= L(self.direction)
+            self.pre_normalized = True
         
     def pointing(self,pts):
-        return np.tile(self.direction,(len(pts),1))
+        return np.broadcast_to(self.direction,pts.shape)
         
     def illumination(self,pts,pointing):
-        return np.tile(self.color,(len(pts),1))
+        return self.color
         
     def glsl(self):
         direction = glsl_vec3(self.direction)
@@ -121,15 +192,18 @@ class PointLight(Light):
     '''A light that is directional within the scene, and obeys 1/r^2'''
 
     def __init__(self,color,position):
-        self.color = A(color)
-        self.position = A(position)
+        self.color = A(color,np.float32)
+        self.position = A(position,np.float32)
         
     def pointing(self,pts):
         return self.position - pts
         
     def illumination(self,pts,pointing):
-        intensity = 1/L(pointing)**2
-        return np.outer(intensity,self.color)
+        intensity = 1/dot(pointing,pointing) # 1/r^2 without the sqrt
+        return intensity[:,None]*self.color
+        
+    def stop_at(self,pts):
+        return self.position
     
     def glsl(self):
         position = glsl_vec3(self.position)
@@ -28,8 +28,16 @@ class Parameter:
         self.ctx = ctx
         self.contents = tuple(contents) if isinstance(contents,list) else contents
         self.noparen = noparen
+        self._code = None
+        self._str = None
+        self._hash = None
         
     def __str__(self):
+        if self._str is None: # contents are immutable, so stringify only once
+            self._str = self.stringify()
+        return self._str
+        
+    def stringify(self):
         match self.contents:
             case str() as s:
                 return s
@@ -52,10 +60,12 @@ class Parameter:
             assert o.ctx == self.ctx, 'Cannot mix parameter contexts!'
             return o
         else:
-            return Parameter(self.ctx,o)
+            return self.ctx.make(o)
             
     def __float__(self):
-        return eval(str(self),self.ctx.globals)
+        if self._code is None: # contents are immutable, so parse only once
+            self._code = compile(str(self),'<param>','eval')
+        return eval(self._code,self.ctx.globals)
         
     def __eq__(self,o):
         if isinstance(o,Parameter):
@@ -70,92 +80,94 @@ class Parameter:
             return self.contents == o
             
     def __hash__(self):
-        return hash(self.contents)^hash(self.noparen)
+        if self._hash is None:
+            self._hash = hash(self.contents)^hash(self.noparen)
+        return self._hash
     
     def __add__(self, o):
         if o == 0:
             return self
         if self == 0:
             return o
-        return Parameter(self.ctx,[self,'+',self.wrap(o)])
+        return self.ctx.make([self,'+',self.wrap(o)])
         
     def __radd__(self, o):
         if o == 0:
             return self
         if self == 0:
             return o
-        return Parameter(self.ctx,[self.wrap(o),'+',self])
+        return self.ctx.make([self.wrap(o),'+',self])
     
     def __sub__(self, o):
         if o == 0:
             return self
         if self == 0:
             return o
-        return Parameter(self.ctx,[self,'-',self.wrap(o)])
+        return self.ctx.make([self,'-',self.wrap(o)])
         
     def __rsub__(self, o):
         if o == 0:
             return self
         if self == 0:
             return o
-        return Parameter(self.ctx,[self.wrap(o),'-',self])
+        return self.ctx.make([self.wrap(o),'-',self])
     
     def __mul__(self, o):
         if o == 0 or self == 0:
-            return Parameter(self.ctx,0)
+            return self.ctx.make(0)
         if o == 1:
             return self
         if self == 1:
             return o
-        return Parameter(self.ctx,[self,'*',self.wrap(o)],noparen=True)
+        return self.ctx.make([self,'*',self.wrap(o)],noparen=True)
         
     def __rmul__(self, o):
         if o == 0 or self == 0:
-            return Parameter(self.ctx,0)
+            return self.ctx.make(0)
         if o == 1:
             return self
         if self == 1:
             return o
-        return Parameter(self.ctx,[self.wrap(o),'*',self],noparen=True)
+        return self.ctx.make([self.wrap(o),'*',self],noparen=True)
     
     def __div__(self, o):
         if o == 1:
             return self
-        return Parameter(self.ctx,[self,'/',self.wrap(o)])
+        return self.ctx.make([self,'/',self.wrap(o)])
     __truediv__ = __div__
         
     def __rdiv__(self, o):
         if self == 1:
             return o
-        return Parameter(self.ctx,[self.wrap(o),'/',self])
+        return self.ctx.make([self.wrap(o),'/',self])
     __rtruediv__ = __rdiv__
     
     def __neg__(self):
-        return Parameter(self.ctx,['-',self],noparen=True)
+        return self.ctx.make(['-',self],noparen=True)
         
     def __abs__(self):
-        return Parameter(self.ctx,['abs(',self,')'],noparen=True)
+        return self.ctx.make(['abs(',self,')'],noparen=True)
         
     def cos(self):
-        return Parameter(self.ctx,['cos(',self,')'],noparen=True)
+        return self.ctx.make(['cos(',self,')'],noparen=True)
         
     def sin(self):
-        return Parameter(self.ctx,['sin(',self,')'],noparen=True)
+        return self.ctx.make(['sin(',self,')'],noparen=True)
         
     def tan(self):
-        return Parameter(self.ctx,['tan(',self,')'],noparen=True)
+        return self.ctx.make(['tan(',self,')'],noparen=True)
         
     def sqrt(self):
-        return Parameter(self.ctx,['sqrt(',self,')'],noparen=True)
+        return self.ctx.make(['sqrt(',self,')'],noparen=True)
         
     def square(self):
-        return Parameter(self.ctx,['pow(',self,',2.)'],noparen=True)
+        return self.ctx.make(['pow(',self,',2.)'],noparen=True)
         
     def __pow__(self,o):
-        return Parameter(self.ctx,['pow(',self,',',self.wrap(o),')'],noparen=True)
+        return self.ctx.make(['pow(',self,',',self.wrap(o),')'],noparen=True)
         
     def __rpow__(self,o):
-        return Parameter(self.ctx,['pow(',self.wrap(o),',',self,')'],noparen=True)
+        return self.ctx.make(['pow(',self.wrap(o),',',self,')'],noparen=True)
         
 class Context:
     ''' A collection of runtime frame-by-frame parameters. '''
@@ -168,11 +180,47 @@ class Context:
             tan=np.tan,
             sqrt=np.sqrt,
             pow=np.power)
+        self._intern = {}
+        
+    folding = {
+        '+': lambda a,b: a+b,
+        '-': lambda a,b: a-b,
+        '*': lambda a,b: a*b,
+        '/': lambda a,b: a/b }
+        
+    def rewrite(self,contents):
+        '''Returns a simpler Parameter equivalent to these contents, or None'''
+        match contents:
+            case (Parameter() as a,str() as op,Parameter() as b) if op in Context.folding:
+                if isinstance(a.contents,(int,float)) and isinstance(b.contents,(int,float)):
+                    if op != '/' or b.contents != 0:
+                        return self.make(Context.folding[op](a.contents,b.contents))
+                elif a is b and op == '-':
+                    return self.make(0)
+            case ('-',Parameter(contents=('-',Parameter() as x))):
+                return x
+        return None
+    
+    def make(self,contents,noparen=False):
+        '''Returns the canonical Parameter for these contents, so that shared 
+           subexpressions are one object (and are stringified and compiled once).
+           Trivial expressions (x-x, -(-x), and literal arithmetic) are rewritten 
+           to a simpler form first. x/x is left alone, since x may be 0, and so is 
+           x*x, since GLSL's pow is undefined for negative x.'''
+        contents = tuple(contents) if isinstance(contents,list) else contents
+        if isinstance(contents,tuple) and (simpler := self.rewrite(contents)) is not None:
+            return simpler
+        key = (type(contents),contents,noparen)
+        param = self._intern.get(key)
+        if param is None:
+            param = self._intern[key] = Parameter(self,contents,noparen=noparen)
+        return param
     
     def __getitem__(self,key):
         if key not in self.globals:
             self.globals[key] = 0.
-        return Parameter(self,key)
+        return self.make(key)
             
     def __setitem__(self,key,value):
         self.globals[key] = value
+
@@ -16,218 +16,285 @@
 #    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
 
 from .util import *
+from .jit import CompiledSDF
 import numpy as np
+import warnings
 
-WORLD_MAX = 1000
-WORLD_RES = 1e-4
-BACKGROUND = A([0,0,0])
+WORLD_MAX = np.float32(1000)
+WORLD_RES = np.float32(1e-4)
+MAX_STEPS = 10000
+MAX_INTERNAL = 5 # total internal reflections followed before giving up
+MIN_BATCH = 16 # a bounce with fewer rays than this is approximated by the background
+MAX_BATCH = 1<<22 # most rays multipass_antialias traces at once, bounding its memory
+BACKGROUND = A([0,0,0],np.float32)
 
-def negate(sdf):
-    return lambda *args,**kwargs: -sdf(*args,**kwargs)
+class negate:
+    '''Inverts the distances of an SDF, for marching through interiors'''
     
-def resolve_transmission(sdf,n1,n2,p,in_d,n):
-    '''For each ray, figure out where and in what direction it leaves the interior of a transparent shape'''
-    out_d = np.empty_like(in_d)
-    out_p = np.copy(p)
+    def __init__(self,sdf):
+        self.sdf = sdf
+        
+    def distance(self,pts):
+        return -self.sdf.distance(pts)
+        
+    __call__ = distance
     
+def reflect(in_d,n,out=None):
+    '''Reflects the directions in_d off surfaces with normals n, reusing one 
+       buffer (out, if given) for every intermediate'''
+    d_n = dot(in_d,n)
+    d_n *= 2
+    out = np.multiply(n,d_n[:,None],out=out)
+    np.subtract(in_d,out,out=out)
+    out /= L(out)[:,None]
+    return out
+    
+def resolve_transmission(sdf,n1,n2,p,in_d,n,scratch=None):
+    '''For each ray, figure out where and in what direction it leaves the interior of a transparent shape'''
     nratio = n1/n2
-    perp_oblique = np.cross(in_d,n,axis=-1)
-    internal = np.square(nratio)*np.sum(perp_oblique*perp_oblique,axis=-1)
+    if isinstance(sdf,CompiledSDF):
+        out_p,out_d,mask = sdf.transmit(p,in_d,n,nratio,WORLD_RES,WORLD_MAX,MAX_STEPS,MAX_INTERNAL)
+        return Rays(p=out_p[mask],d=out_d[mask]),mask
+    if scratch is None:
+        scratch = Scratch()
+    out = scratch.get('out_pd',(len(p),6),p.dtype) # positions and directions, as in Rays
+    out_p,out_d = out[:,:3],out[:,3:]
+    out_p[:] = p
+    
+    perp_oblique = cross3(in_d,n)
+    internal = np.square(nratio)*dot(perp_oblique,perp_oblique)
     
     #these stay outside
     totaled = internal > 1
-    in_d_dot_n = np.sum((in_d_t:=in_d[totaled])*(n_t:=n[totaled]),axis=-1)
-    out_d[totaled] = N(in_d_t - (2*in_d_dot_n*n_t.T).T)
+    out_d[totaled] = reflect(in_d[totaled],n[totaled])
     
     #these go inside
     processing = ~totaled
-    out_d = np.empty_like(in_d)
-    out_d[processing] = (nratio[processing] * np.cross((n_p:=n[processing]),perp_oblique[processing],axis=-1).T - n_p.T*np.sqrt(1-internal[processing])).T
+    out_d[processing] = nratio[processing,None]*cross3((n_p:=n[processing]),perp_oblique[processing]) - n_p*np.sqrt(1-internal[processing])[:,None]
     
     #print('Finding refracted path')
     #find where they come out
-    inner_sdf = negate(sdf)
+    inner_sdf = sdf.negated() if isinstance(sdf,CompiledSDF) else negate(sdf)
     nratio = 1/nratio
     i = 0
     while np.any(processing): #total internal reflection loop
         i = i+1
-        if i > 5:
+        if i > MAX_INTERNAL:
             #print('Assuming totally internally reflected')
             break
         #print('Refracted:',i)
-        inner_lr = Rays(p=out_p[processing],d=out_d[processing])
-        out_p[processing],out_g,valid = next_surface(inner_lr,inner_sdf)
+        inner_lr = Rays(buf=out[processing])
+        out_p[processing],out_g,valid = next_surface(inner_lr,inner_sdf,scratch=scratch)
         processing[processing] = valid
         out_n = N(out_g[valid])
         nr = nratio[processing]
-        perp_oblique = np.cross(out_d[processing],out_n,axis=-1)
-        internal = np.square(nr)*np.sum(perp_oblique*perp_oblique,axis=-1)
+        perp_oblique = cross3(out_d[processing],out_n)
+        internal = np.square(nr)*dot(perp_oblique,perp_oblique)
         tot = internal > 1
         esc = ~tot
         escaped = np.copy(processing)
         escaped[escaped] = esc
-        out_d[escaped] = (nr[esc] * np.cross(out_n[esc],perp_oblique[esc],axis=-1).T - out_n[esc].T*np.sqrt(1-internal[esc])).T
+        out_d[escaped] = nr[esc,None]*cross3(out_n[esc],perp_oblique[esc]) - out_n[esc]*np.sqrt(1-internal[esc])[:,None]
         processing[processing] = tot # these keep going
-        out_d_dot_out_n = np.sum(out_d[processing]*(out_n_t:=out_n[tot]) ,axis=-1)
-        out_d[processing] = N(out_d[processing] - (2*out_d_dot_out_n*out_n_t.T).T)
-    return Rays(p=out_p[mask:=~processing],d=out_d[mask]),mask
+        out_d[processing] = reflect(out_d[processing],out_n[tot])
+    return Rays(buf=out[mask:=~processing]),mask
         
-def next_surface(rays,sdf,stop_at=None,lighting=False):
-    '''For each ray, return the position and gradient of the next surface intersection in the SDF'''
-    p = np.copy(rays.p)
+def next_surface(rays,sdf,stop_at=None,lighting=False,scratch=None):
+    '''For each ray, return the position and gradient of the next surface intersection in the SDF.
+       Passing a scratch reuses its buffers for the positions, gradients, hits, and 
+       bookkeeping, so the results are only valid until the next call sharing it.'''
+    if isinstance(sdf,CompiledSDF):
+        p,g_res,intersected = sdf.march(rays,WORLD_RES,WORLD_MAX,MAX_STEPS,stop_at)
+        return p,(g_res if not lighting else False),intersected
+    if scratch is None:
+        scratch = Scratch()
+    buf = scratch.get('ns_rays',rays.buf.shape) # positions are advanced in this copy
+    np.copyto(buf,rays.buf)
+    p = buf[:,:3]
+    if stop_at is not None: # one stop for every ray, or one each
+        stop_at = np.broadcast_to(stop_at,p.shape)
     #print('Intersecting:',len(p))
-    alive = np.arange(len(p))
-    g_res = np.empty_like(p) if not lighting else False
-    intersected = np.zeros(len(p),dtype=bool)
+    # alive rays are compacted in place (ping-ponging between two index buffers)
+    # rather than reallocated by a fancy index for every mask applied each step
+    alive_buf,spare_buf = scratch.get('ns_alive',(len(p),),np.int32),scratch.get('ns_spare',(len(p),),np.int32)
+    alive_buf[:] = np.arange(len(p),dtype=np.int32)
+    keep_buf = scratch.get('ns_keep',(len(p),),bool)
+    n_alive = len(p)
+    g_res = scratch.get('ns_g',p.shape) if not lighting else False
+    intersected = scratch.get('ns_hit',(len(p),),bool)
+    intersected.fill(False)
+    distance = sdf.distance
     i = 0
-    while len(alive) > 0:
-        sd = sdf(p[alive])
-        if np.any(m := (sd < 0)):
-            #FIXME this needs direction dependence 
-            sd[m] = np.abs(sd[m])+WORLD_RES
-        #if np.any(m := (sd < -WORLD_RES)):
-        #    m = ~m
-        #    alive = alive[m]
-        #    p_alive = p_alive[m]
-        #    sd = sd[m]
-        if np.any(m := (sd < WORLD_RES)):
-            zombie = alive[m]
-            g_zombie = G(sdf,p[zombie])
-            moving_towards = np.sum(g_zombie*rays.d[zombie],axis=-1) < 0
-            dead = zombie[moving_towards]
+    while n_alive > 0:
+        alive = alive_buf[:n_alive]
+        keep = keep_buf[:n_alive]
+        pd_alive = buf[alive] # p and d gathered together, once per step
+        p_alive,d_alive = pd_alive[:,:3],pd_alive[:,3:]
+        sd = distance(p_alive)
+        #FIXME this needs direction dependence 
+        sd = np.where(sd < 0,WORLD_RES-sd,sd)
+        np.greater_equal(sd,WORLD_RES,out=keep) # one mask for the whole step
+        near = np.flatnonzero(~keep)
+        if len(near) > 0:
+            g_zombie = G(distance,p_alive[near])
+            towards = np.flatnonzero(dot(g_zombie,d_alive[near]) < 0)
+            dead = alive[near[towards]]
             if not lighting:
-                g_res[dead] = g_zombie[moving_towards]
+                g_res[dead] = g_zombie[towards]
             intersected[dead] = True
-            m[m] = moving_towards
-            m = ~m
-            alive = alive[m]
-            sd = sd[m]
-        if np.any(m := L(p[alive]) > WORLD_MAX):
-            m = ~m
-            alive = alive[m]
-            sd = sd[m]
+            keep[near] = True # rays moving away from the surface carry on
+            keep[near[towards]] = False
+        keep &= dot(p_alive,p_alive) <= WORLD_MAX*WORLD_MAX
         if stop_at is not None:
-            if np.any(m := (np.sum((stop_at-p_alive)*rays.d[alive],axis=-1) < 0)):
-                m = ~m
-                alive = alive[m]
-                p_alive = p_alive[m]
-                sd = sd[m]
+            keep &= dot(stop_at[alive]-p_alive,d_alive) >= 0
+        n_alive = np.count_nonzero(keep)
+        alive = np.compress(keep,alive,out=spare_buf[:n_alive])
+        alive_buf,spare_buf = spare_buf,alive_buf
         i = i+1
-        if i > 10000:
-            print('TOO MANY STEPS')
+        if i > MAX_STEPS:
+            warnings.warn(f'{len(alive)} rays still marching after MAX_STEPS={MAX_STEPS} steps')
             return p,g_res,intersected
-        p[alive,:] += (rays.d[alive].T*np.abs(sd)).T
+        # rays leaving a surface step at least WORLD_RES, or float32 rounding can pin them there
+        p[alive,:] += np.compress(keep,d_alive,axis=0)*np.maximum(np.compress(keep,sd),WORLD_RES)[:,None]
     #print(i,'STEPS')
     return p,g_res,intersected
     
-def march_many(rays,sdf,lights,prescale=None):
-    '''Run the optical simulation to compute the observed colors along each ray'''
-    #print('Projecting foreground')
-    p,g,foreground = next_surface(rays,sdf)
-    p,g = p[foreground],g[foreground]
-    n = N(g)
-    in_d = rays.d[foreground]
-    prescale = prescale[foreground] if prescale is not None else None
-    
-    colors = np.zeros((len(foreground),3),dtype=np.float32)
-    colors[~foreground] = BACKGROUND
-    
-    surfs = sdf(p,properties=True)
-    
-    specular = A([s.specular for s in surfs])
-    diffuse = A([s.diffuse for s in surfs])
-    transmit = A([s.transmit for s in surfs])
-    refractive = A([s.refractive_index for s in surfs])
-    
-    # Transmission
-    transmit_mask = transmit > 0
-    if np.any(transmit_mask):
-        transmit_scale = transmit[transmit_mask]
-        if prescale is None:
-            absolute = transmit_scale
-        else:
-            #print('S',np.mean(transmit_scale),np.max(transmit_scale),np.min(transmit_scale))
-            #print('P',np.mean(prescale[transmit_mask]),np.max(prescale[transmit_mask]),np.min(prescale[transmit_mask]))
-            absolute = transmit_scale*prescale[transmit_mask]
-        #print('A',np.mean(absolute),np.max(absolute),np.min(absolute))
-        if np.any(m:=(absolute>1e-3)):   
-            transmit_mask[transmit_mask] = m #destructive
-            trx_p = p[transmit_mask]
-            trx_n = n[transmit_mask]
-            trx_in_d = in_d[transmit_mask]
+def march_many(rays,sdf,lights,prescale=None,min_batch=MIN_BATCH,scratch=None):
+    '''Run the optical simulation to compute the observed colors along each ray.
+       Rays spawned by transmission and reflection are traced as a wavefront, one
+       bounce at a time, each carrying its weight in the final color (prescale) 
+       and the index of the original ray it contributes to. Once a bounce has 
+       fewer than min_batch rays, they are not traced further. Passing a scratch 
+       reuses its buffers across calls.'''
+    rays = Rays(buf=np.asarray(rays.buf,dtype=np.float32))
+    n_rays = len(rays.p)
+    scored = [(np.empty(0,dtype=np.intp),np.empty((0,3),dtype=np.float32))] # (dest,color) of every contribution
+    weight = np.ones(n_rays,dtype=np.float32) if prescale is None else prescale
+    dest = np.arange(len(rays.p))
+    if scratch is None:
+        scratch = Scratch()
+    while len(dest) > 0:
+        #print('Projecting foreground')
+        p,g,foreground = next_surface(rays,sdf,scratch=scratch)
+        # rays are selected by index arrays, so each array is gathered once per branch
+        fg = np.flatnonzero(foreground)
+        if BACKGROUND.any(): # a black background contributes nothing
+            bg = np.flatnonzero(~foreground)
+            scored.append((dest[bg],weight[bg,None]*BACKGROUND))
+        p,g = p[fg],g[fg]
+        n = N(g)
+        in_d = rays.d[fg]
+        weight,dest = weight[fg],dest[fg]
+        
+        surfs = sdf.properties(p)
+        
+        specular = surfs.specular
+        diffuse = surfs.diffuse
+        transmit = surfs.transmit
+        refractive = surfs.refractive_index
+        
+        spawned = [] # (rays,weight,dest) for the next bounce
+        
+        # Transmission
+        absolute = transmit*weight
+        idx = np.flatnonzero(absolute>1e-3)
+        if len(idx) > 0:
+            trx_p = p[idx]
+            trx_n = n[idx]
+            trx_in_d = in_d[idx]
             
-            n1 = np.ones(len(trx_p))
-            n2 = refractive[transmit_mask]
+            n1 = np.ones(len(trx_p),dtype=np.float32)
+            n2 = refractive[idx]
             
             #print('Calculating transmission')
-            tr,valid = resolve_transmission(sdf,n1,n2,trx_p,trx_in_d,trx_n)
-            transmit_mask[transmit_mask] = valid
-            transmit_colors = march_many(tr,sdf,lights,prescale=absolute[m][valid])
-            fg = np.copy(foreground)
-            fg[fg] = transmit_mask
-            
-            colors[fg] += (transmit_colors.T*transmit_scale[m][valid]).T
+            tr,valid = resolve_transmission(sdf,n1,n2,trx_p,trx_in_d,trx_n,scratch)
+            idx = idx[valid]
+            spawned.append((tr,absolute[idx],dest[idx]))
 
-    # Diffuse reflectivity
-    diffuse_mask = diffuse > 0
-    if np.any(diffuse_mask):
-        diffuse_scale = diffuse[diffuse_mask]
-        ref_p = p[diffuse_mask]
-        ref_n = n[diffuse_mask]
-        ref_surf = surfs[diffuse_mask]
-        ref_in_d = in_d[diffuse_mask]
-        diffuse_light = np.zeros((len(ref_p),3),dtype=np.float32)
-        for li in lights:
-            li.light(ref_p,ref_surf,ref_in_d,ref_n,sdf,diffuse_light,lights=lights,prescale=diffuse_scale)
-        fg = np.copy(foreground)
-        fg[fg] = diffuse_mask
-        colors[fg] += (diffuse_light.T*diffuse_scale).T
-        
-    # Specular reflectivity
-    spec_mask = specular > 0
-    if np.any(spec_mask):
-        specular_scale = specular[spec_mask]
-        if prescale is None:
-            absolute = specular_scale
-        else:
-            #print('S',np.mean(specular_scale),np.max(specular_scale),np.min(specular_scale))
-            #print('P',np.mean(prescale[spec_mask]),np.max(prescale[spec_mask]),np.min(prescale[spec_mask]))
-            absolute = specular_scale*prescale[spec_mask]
-        #print('A',np.mean(absolute),np.max(absolute),np.min(absolute))
-        if np.any(m:=(absolute>1e-3)):
-            spec_mask[spec_mask] = m
-            ref_p = p[spec_mask]
-            ref_n = n[spec_mask]
-            ref_in_d = in_d[spec_mask]
+        # Diffuse reflectivity
+        idx = np.flatnonzero(diffuse > 0)
+        if len(idx) > 0:
+            diffuse_scale = diffuse[idx]
+            ref_p = p[idx]
+            ref_n = n[idx]
+            ref_colors = surfs.color[idx]
+            ref_in_d = in_d[idx]
+            diffuse_light = scratch.get('diffuse_light',(len(ref_p),3))
+            diffuse_light.fill(0)
+            for li in lights:
+                li.light(ref_p,ref_colors,ref_in_d,ref_n,sdf,diffuse_light,lights=lights,prescale=diffuse_scale)
+            absolute = diffuse_scale*weight[idx]
+            scored.append((dest[idx],diffuse_light*absolute[:,None]))
             
-            ref_in_d_dot_n = np.sum(ref_in_d*ref_n ,axis=-1)
-            ref_d = N(ref_in_d - (2*ref_in_d_dot_n*ref_n.T).T)
-            sr = Rays(p=ref_p,d=ref_d)
+        # Specular reflectivity
+        absolute = specular*weight
+        idx = np.flatnonzero(absolute>1e-3)
+        if len(idx) > 0:
+            ref_p = p[idx]
+            ref_n = n[idx]
+            ref_in_d = in_d[idx]
+            
+            ref_d = reflect(ref_in_d,ref_n)
             #print('Calculating reflection')
-            specular_colors = march_many(sr,sdf,lights,prescale=absolute[m])
-            fg = np.copy(foreground)
-            fg[fg] = spec_mask
-            colors[fg] += (specular_colors.T*specular_scale[m]).T
+            spawned.append((Rays(p=ref_p,d=ref_d),absolute[idx],dest[idx]))
+        
+        if len(spawned) == 0:
+            break
+        rays = Rays.concatenate([r for r,w,d in spawned])
+        weight = np.concatenate([w for r,w,d in spawned])
+        dest = np.concatenate([d for r,w,d in spawned])
+        if len(dest) < min_batch:
+            if BACKGROUND.any():
+                scored.append((dest,weight[:,None]*BACKGROUND))
+            break
     
+    # scatter every contribution into its original ray once, at the end
+    dest = np.concatenate([d for d,c in scored])
+    contrib = np.concatenate([c for d,c in scored])
+    colors = np.stack([np.bincount(dest,weights=contrib[:,i],minlength=n_rays) for i in range(3)],axis=-1).astype(np.float32)
     return colors if prescale is not None else np.minimum(colors*255,255).astype(np.uint8)
     
-def multipass_antialias(rays,sdf,lights,ang_res,seed):
-    '''Simple anti-aliasing algorithm that samples random perturbations around the specified rays'''
-    np.random.seed(seed)
+def perturb(rays,ang_res,seed,scratch=None):
+    '''Samples random perturbations of about ang_res degrees around the specified rays.
+       Passing the same scratch to each call reuses its random sample buffers.'''
+    rng = np.random.default_rng(seed)
     if ang_res is not None and ang_res > 0:
-        different = np.empty_like(rays.d)
-        m = np.abs(rays.d[:,0])<0.5
-        different[m] = A([1,0,0])
-        different[~m] = A([0,1,0]);
-        perp_1 = np.cross(rays.d,different)
-        perp_2 = np.cross(rays.d,perp_1)
-        angular_error = np.random.normal(0,ang_res*np.pi/180,len(rays.d))
-        phi = np.random.random(len(rays.d))*np.pi*2
+        if scratch is None:
+            scratch = Scratch()
+        different = np.where(np.abs(rays.d[:,0:1])<0.5,A([1,0,0],rays.d.dtype),A([0,1,0],rays.d.dtype))
+        perp_1 = cross3(rays.d,different)
+        perp_2 = cross3(rays.d,perp_1)
+        angular_error = rng.standard_normal(dtype=np.float32,out=scratch.get('angular_error',(len(rays.d),)))
+        angular_error *= ang_res*np.pi/180
+        phi = rng.random(dtype=np.float32,out=scratch.get('phi',(len(rays.d),)))
+        phi *= np.pi*2
         costheta = np.cos(angular_error)
         sintheta = np.sin(angular_error)
-        perturbed = ((costheta*rays.d.T)+sintheta*(perp_1.T*np.cos(phi)+perp_2.T*np.sin(phi))).T
+        perturbed = costheta[:,None]*rays.d + sintheta[:,None]*(perp_1*np.cos(phi)[:,None] + perp_2*np.sin(phi)[:,None])
         rays = Rays(p=rays.p,d=perturbed)
-    return march_many(rays,sdf,lights)
+    return rays
+
+def multipass_antialias(rays,sdf,lights,ang_res,seeds,scratch=None,pool=None,workers=1):
+    '''Simple anti-aliasing algorithm that averages passes of random perturbations 
+       around the specified rays, one pass per seed. Passes are traced together in
+       batches of up to MAX_BATCH rays, with at least one batch per worker if given 
+       a pool (an executor from `concurrent.futures`) to run them on.'''
+    def trace(seeds,scratch):
+        passes = [perturb(rays,ang_res,seed,scratch) for seed in seeds]
+        batch = Rays.concatenate(passes)
+        colors = march_many(batch,sdf,lights,scratch=scratch).reshape((len(seeds),len(rays.d),3))
+        return colors.sum(axis=0,dtype=acc)
+    acc = np.uint16 if len(seeds) <= 257 else np.uint32 # 257*255 still fits in 16 bits
+    workers = min(workers,len(seeds)) if pool is not None else 1
+    per_batch = max(1,MAX_BATCH//max(1,len(rays)))
+    groups = np.array_split(seeds,max(workers,-(-len(seeds)//per_batch)))
+    if workers < 2:
+        scratch = scratch if scratch is not None else Scratch()
+        total = sum(trace(group,scratch) for group in groups)
+    else: # scratch buffers are not shared between threads
+        total = sum(pool.map(trace,groups,[Scratch() for group in groups]))
+    total //= len(seeds) # truncates as the float divide did, without a float frame
+    return total.astype(np.uint8)
     
     
 glsl_core = '''
@@ -16,16 +16,18 @@
 #    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
 
 from .util import *
-from scipy.spatial.transform import Rotation as R
 from .render import *
-from .light import PointLight
+from .light import PointLight,LightGroup
 from .shapes import Sphere
 from .geom import Union
 from .surface import UniformSurface,SurfaceProp
-from functools import partial
+from .jit import HAVE_NUMBA,NotCompilable,CompiledSDF,FusedSDF
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import os
 import re
+import warnings
         
 class Camera:
     '''Abstracts a camera or viewer as a collection of rays through a viewscreen'''
@@ -35,7 +37,7 @@ class Camera:
                  aspect_ratio = 1.618,    
                  screen_width = 0.1,
                  viewing_dist = 0.1,
-                 camera_orig = A([0,0,-10]),
+                 camera_orig = A([0,0,-10],np.float32),
                  camera_pitch = 0,
                  camera_yaw = 0,
                  camera_roll = 0):
@@ -46,15 +48,19 @@ class Camera:
         self.screen_width = screen_width
         x = np.linspace(-0.5,0.5,self.width_px)
         y = np.linspace(-1/2/aspect_ratio,1/2/aspect_ratio,self.height_px)
-        self.X,self.Y = np.meshgrid(x,-y)
         
-        self.pixel_locations_cam = A([screen_width/2*self.X.flatten(),
-                                      screen_width/2*self.Y.flatten(),
-                                      np.full(self.width_px*self.height_px,self.viewing_dist)]).T
+        # row-major pixels: x varies fastest, rows run top (+y) to bottom
+        self.pixel_locations_cam = np.empty((self.height_px,self.width_px,3),dtype=np.float32)
+        self.pixel_locations_cam[...,0] = screen_width/2*x
+        self.pixel_locations_cam[...,1] = -screen_width/2*y[:,None]
+        self.pixel_locations_cam[...,2] = self.viewing_dist
+        self.pixel_locations_cam = self.pixel_locations_cam.reshape(-1,3)
+        self.pixel_dirs_cam = N(self.pixel_locations_cam) # rotations keep these unit length
         self.camera_orig = camera_orig
         self.camera_pitch = camera_pitch
         self.camera_yaw = camera_yaw
         self.camera_roll = camera_roll
+        self.rays = None
         self.adjust()
         
     def adjust(self,
@@ -62,60 +68,100 @@ class Camera:
                camera_pitch = None,
                camera_yaw = None,
                camera_roll = None):
-        '''For moving a camera orientation, and recomputing rays'''
+        '''For moving a camera orientation, and recomputing rays. Moving only the 
+           origin reuses the ray directions, and just rewrites the ray origins.'''
         
+        reorient = self.rays is None
         if camera_orig is not None:
             self.camera_orig = camera_orig
         if camera_pitch is not None:
             self.camera_pitch = camera_pitch
+            reorient = True
         if camera_yaw is not None:
             self.camera_yaw = camera_yaw
+            reorient = True
         if camera_roll is not None:
             self.camera_roll = camera_roll
+            reorient = True
         
-        self.proj = ZROT(self.camera_roll)@YROT(self.camera_yaw)@XROT(self.camera_pitch)
-        #self.proj = R.from_euler(seq='XYZ',angles=[self.camera_pitch,self.camera_yaw,self.camera_roll]).as_matrix()
+        if not reorient:
+            self.rays.p[:] = np.asarray(self.camera_orig,dtype=np.float32)
+            return
+        
+        self.proj = euler_to_mat('xyz',[self.camera_pitch,self.camera_yaw,self.camera_roll])
 
-        self.pixel_directions_world = (np.asarray(self.proj,dtype=np.float64) @ np.asarray(self.pixel_locations_cam,dtype=np.float64).T).T
+        self.pixel_directions_world = np.einsum('ij,nj->ni',np.asarray(self.proj,dtype=np.float32),self.pixel_dirs_cam)
 
-        self.rays = Rays(p=np.tile(self.camera_orig,(len(self.pixel_directions_world),1)),d=N(self.pixel_directions_world))
+        self.rays = Rays(p=np.asarray(self.camera_orig,dtype=np.float32),d=self.pixel_directions_world)
 
 def deduplicate(fragments):
-    included = set()
-    result = []
-    for f in fragments:
-        if f in included:
-            continue
-        included.add(f)
-        result.append(f)
-    return result
+    '''The unique fragments, in order of first appearance'''
+    return list(dict.fromkeys(fragments))
 
 class Scene:
     '''A renderable scene consists of a SDF geometry, some number of lights, and 
-       a Camera to specifiy what perspective to render'''
-    def __init__(self,sdf,lights,cam=Camera()):
+       a Camera to specifiy what perspective to render. With specialize, the numba
+       kernels are compiled for this geometry, which costs seconds up front but 
+       speeds up animations and long renders.'''
+    def __init__(self,sdf,lights,cam=Camera(),specialize=False):
         self.sdf = sdf
         self.lights = lights
         self.cam = cam
+        self.specialize = specialize
         self._glpg = None
+        self._vbo = None
+        self._programs = {}
+        self._glsl = {}
         self._res = None
         self._ctx = None
+        self._cpu_sdf = None
+        self._cpu_sdf_of = None
+        self._scratch = Scratch()
+        self._pool = None
+        self._workers = None
         
-    def cpu_render(self,antialias=None,ang_res=0.):
-        '''Heavy lifting is done in the `render` module'''
+    def cpu_sdf(self):
+        '''The simplified SDF used for CPU rendering, flattened into a single numba kernel
+           when numba is available (or else one generated numpy function) and every node 
+           in the tree supports it. This is built once per SDF tree assigned to the 
+           Scene; only Parameter values are re-evaluated per frame.'''
+        if self._cpu_sdf is None or self._cpu_sdf_of is not self.sdf:
+            self._cpu_sdf_of = self.sdf
+            self._cpu_sdf = self.sdf.simplify()
+            try:
+                self._cpu_sdf = CompiledSDF(self._cpu_sdf,self.specialize) if HAVE_NUMBA else FusedSDF(self._cpu_sdf)
+            except NotCompilable as e:
+                warnings.warn(f'{e}, so the SDF tree is evaluated node by node')
+        elif isinstance(self._cpu_sdf,(CompiledSDF,FusedSDF)):
+            self._cpu_sdf.refresh() #pick up new Parameter values without rebuilding
+        return self._cpu_sdf
+        
+    def cpu_render(self,antialias=None,ang_res=0.,workers=None):
+        '''Heavy lifting is done in the `render` module. Antialiasing passes are split
+           across a pool of worker threads (one per core by default), unless the SDF
+           is a numba kernel, which already uses every core.'''
         out_shape = (self.cam.height_px,self.cam.width_px,3)
+        sdf = self.cpu_sdf()
         if antialias is not None:
-            colors = np.zeros(out_shape,dtype=np.uint32)
-            fn = partial(multipass_antialias,self.cam.rays,self.sdf,self.lights,ang_res)
             seeds = np.random.randint(2**32,size=antialias,dtype=np.uint64).astype(np.int64)
-            for i,c in enumerate(map(fn,seeds)):
-                colors += c.reshape(out_shape)
-            return Image.fromarray((colors/antialias).astype(np.uint8))
+            if workers is None:
+                workers = 1 if isinstance(sdf,CompiledSDF) else os.cpu_count()
+            if workers > 1 and workers != self._workers:
+                if self._pool is not None:
+                    self._pool.shutdown()
+                self._pool,self._workers = ThreadPoolExecutor(max_workers=workers),workers
+            colors = multipass_antialias(self.cam.rays,sdf,[LightGroup(self.lights)],ang_res,seeds,self._scratch,self._pool,workers)
+            return Image.fromarray(colors.reshape(out_shape))
         else:
-            return Image.fromarray(march_many(self.cam.rays,self.sdf,self.lights).reshape(out_shape))
+            return Image.fromarray(march_many(self.cam.rays,sdf,[LightGroup(self.lights)],scratch=self._scratch).reshape(out_shape))
             
     def clear_cache(self):
+        self._cpu_sdf = None
+        self._cpu_sdf_of = None
+        self._scratch = Scratch()
         self._glpg = None
+        self._programs = {}
+        self._glsl = {}
         self._vbo = None
         self._fbo = None
         self._res = None
@@ -134,18 +180,20 @@ class Scene:
             }
         '''
         res = (self.cam.width_px,self.cam.height_px)
-        if self._glpg is None:
+        key = tuple(sorted(kwargs.items())) # one compiled program per set of glsl options
+        if key not in self._programs:
             fragment_shader = self.glsl(**kwargs)
             try:
-                self._glpg  = ctx.program(vertex_shader=vertex_shader,fragment_shader=fragment_shader)
+                glpg  = ctx.program(vertex_shader=vertex_shader,fragment_shader=fragment_shader)
             except:
                 print('\n'.join([f'{i:04} {l}' for i,l in enumerate(fragment_shader.split('\n'))]))
                 raise
-        
-            data = np.asarray([-1,1,-1,-1,1,1,1,-1],dtype=np.float32)
-            self._vbo = ctx.buffer(data.tobytes())
+            if self._vbo is None:
+                data = np.asarray([-1,1,-1,-1,1,1,1,-1],dtype=np.float32)
+                self._vbo = ctx.buffer(data.tobytes())
+            self._programs[key] = (glpg,ctx.simple_vertex_array(glpg, self._vbo, 'position'))
+        self._glpg,self._vao = self._programs[key]
         if self._res is None or self._res != res:
-            self._vao = ctx.simple_vertex_array(self._glpg, self._vbo, 'position')
             self._fbo = ctx.simple_framebuffer(res, dtype='f4')
             self._res = res
 
@@ -178,6 +226,11 @@ class Scene:
         
             
     def glsl(self,ang_res=0.,true_optics=False):
+        '''The fragment shader for this scene, generated once per set of options 
+           (until `clear_cache`)'''
+        key = (ang_res,true_optics)
+        if key in self._glsl:
+            return self._glsl[key]
         
         if true_optics:
             renderer = 'vec3 color = cast_ray_rt(cam_orig,normalize(cam_proj*px_cam_i));'
@@ -243,12 +296,7 @@ class Scene:
                 
                 vec3 px_cam_i;
                 if (ang_res > 0.) {{
-                    vec3 different;
-                    if (abs(px_cam.x) > 0.5) {{
-                        different = vec3(0.,1.,0.);
-                    }} else {{
-                        different = vec3(1.,0.,0.);
-                    }}
+                    vec3 different = abs(px_cam.x) > 0.5 ? vec3(0.,1.,0.) : vec3(1.,0.,0.);
                     vec3 p1 = cross(px_cam,different);
                     vec3 p2 = cross(px_cam,p1);
                     float theta = rand_normal()*ang_res*3.14159/180.;
@@ -280,6 +328,7 @@ class Scene:
             elems = [rep.sub('',e) for e in elems]
             return '\n'.join(elems)
         fragment_shader = ''.join([process(e) for e in elements])
+        self._glsl[key] = fragment_shader
         return fragment_shader
 
             
@@ -26,13 +26,20 @@ class Sphere(SDF):
         self.radius = radius
         
     def fn(self,pts):
-        return L(pts) - self.radius
+        x,y,z = pts[...,0],pts[...,1],pts[...,2] # faster than einsum over a length-3 axis
+        return np.sqrt(x*x + y*y + z*z) - self.radius
     
     def glsl_geo(self,tx,rot):
         geo = f'sphere(p,{tx},{glsl_float(self.radius)})'
         frags = [Sphere.glsl_function]
         return geo,frags
         
+    def compile_geo(self):
+        return OP_SPHERE,[self.radius]
+        
+    def bound_geo(self):
+        return np.zeros(3),float(self.radius)
+        
     glsl_function = '''
         float sphere(vec3 p, vec3 tx, float radius) {
             return length(p - tx) - radius;
@@ -43,25 +50,37 @@ class Box(SDF):
 
     def __init__(self,width=1,height=1,depth=1,**kwargs):
         super().__init__(**kwargs)
-        self.dims = A([width,height,depth])
+        self.dims = A([width,height,depth],np.float32)
         
     def fn(self,pts):
-        deltas = np.abs(pts)-self.dims/2
-        return L(np.maximum(deltas,0.0)) + np.minimum(np.max(deltas,axis=-1),0.0)
+        deltas = np.abs(pts)
+        deltas -= self.dims/2 # every step below reuses this one temporary in place
+        dist = np.minimum(np.max(deltas,axis=-1),0.0)
+        dist += L(np.maximum(deltas,0.0,out=deltas))
+        return dist
     
     def glsl_geo(self,tx,rot):
         whd = glsl_vec3(self.dims)
-        geo = f'box(p,{tx},{rot},{whd})'
+        geo = f'box(p,{tx},{whd})' if rot == GLSL_IDENTITY else f'box(p,{tx},{rot},{whd})'
         frags = [Box.glsl_function]
         return geo,frags
         
+    def compile_geo(self):
+        return OP_BOX,self.dims/2
+        
+    def bound_geo(self):
+        return np.zeros(3),L(np.asarray(self.dims,dtype=np.float64))/2
+        
     glsl_function = '''
-        float box(vec3 p, vec3 tx, mat3 rot, vec3 whd) {
-            p = rot*(p-tx);
-            vec3 del = abs(p)-whd/2.;
+        float box(vec3 p, vec3 tx, vec3 whd) {
+            vec3 del = abs(p-tx)-whd/2.;
             float mval = max(max(del.x,del.y),del.z);
             return length(vec3(max(del.x,0.),max(del.y,0.),max(del.z,0.)))+min(mval,0.);
         }
+        
+        float box(vec3 p, vec3 tx, mat3 rot, vec3 whd) {
+            return box(rot*(p-tx),vec3(0.),whd);
+        }
     '''
 
 class Cylinder(SDF):
@@ -72,33 +91,47 @@ class Cylinder(SDF):
         self.radius = radius
         
     def fn(self,pts):
-        a = L(pts[...,[0,2]]) - self.radius
+        x,z = pts[...,0],pts[...,2] # strided views, not a fancy-indexed copy
+        a = np.sqrt(x*x + z*z) - self.radius
         b = np.abs(pts[...,1]) - self.height/2
-        return np.minimum(np.maximum(a,b),0.0) + L(np.maximum(A([a,b]).T,0))
+        ma,mb = np.maximum(a,0.0),np.maximum(b,0.0)
+        return np.minimum(np.maximum(a,b),0.0) + np.sqrt(ma*ma + mb*mb)
         
     def glsl_geo(self,tx,rot):
-        geo = f'cylinder(p,{tx},{rot},{glsl_float(self.height)},{glsl_float(self.radius)})'
+        hr = f'{glsl_float(self.height)},{glsl_float(self.radius)}'
+        geo = f'cylinder(p,{tx},{hr})' if rot == GLSL_IDENTITY else f'cylinder(p,{tx},{rot},{hr})'
         frags = [Cylinder.glsl_function]
         return geo,frags
         
+    def compile_geo(self):
+        return OP_CYLINDER,[self.height/2,self.radius]
+        
+    def bound_geo(self):
+        return np.zeros(3),np.hypot(float(self.height)/2,float(self.radius))
+        
     glsl_function = '''
-        float cylinder(vec3 p, vec3 tx, mat3 rot, float height, float radius) {
-            p = rot*(p-tx);
+        float cylinder(vec3 p, vec3 tx, float height, float radius) {
+            p = p-tx;
             float a = length(p.xz)-radius;
             float b = abs(p.y)-height/2.;
             return min(max(a,b),0.) + length(vec2(max(a,0.),max(b,0.)));
         }
+        
+        float cylinder(vec3 p, vec3 tx, mat3 rot, float height, float radius) {
+            return cylinder(rot*(p-tx),vec3(0.),height,radius);
+        }
     '''
 
 class Plane(SDF):
 
     def __init__(self,anchor=A([0,-1,0]),normal=A([0,1,0]),**kwargs):
         super().__init__(**kwargs)
-        self.anchor = A(anchor)
-        self.normal = N(A(normal))
+        self.anchor = A(anchor,np.float32)
+        self.normal = N(A(normal,np.float32))
+        self.offset = np.sum(self.anchor*self.normal) # the plane is pts@normal == offset
         
     def fn(self,pts):
-        return np.sum((pts - self.anchor)*self.normal,axis=-1)
+        return pts @ self.normal - self.offset
         
     def glsl_geo(self,tx,rot):
         norm = f'vec3({self.normal[0]},{self.normal[1]},{self.normal[2]})'
@@ -113,6 +146,9 @@ class Plane(SDF):
         frags = [Plane.glsl_function]+sfrags
         return geo,frags
         
+    def compile_geo(self):
+        return OP_PLANE,list(self.normal)+[self.offset]
+        
     glsl_function = '''
         float plane(vec3 p, vec3 anchor, vec3 norm) {
             return dot(p-anchor,norm);
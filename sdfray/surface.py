@@ -16,7 +16,14 @@
 #    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
 
 from .util import *
+from .jit import HAVE_NUMBA,HAVE_CUDA,BLOCK,CUDA_MIN_POINTS,perlin_noise,cube_map_pixels,checker_squares
+if HAVE_CUDA:
+    from .jit import cuda,perlin_noise_cuda
+from operator import attrgetter
+from functools import cached_property
+from itertools import chain
 import numpy as np
+import threading
 
 class SurfaceProp:
     '''Defines properties of a surface'''
@@ -31,7 +38,12 @@ class SurfaceProp:
         self.transmit = transmit
         self.color = color
         self.emittance = emittance
-        self.name = f'var_{hash((diffuse,specular,refractive_index,transmit,tuple(color),tuple(emittance))) % 100000000}'
+        
+    @cached_property
+    def name(self):
+        '''GLSL variable name, shared by equal properties. Only hashed when a 
+           shader needs it, not for every SurfaceProp made on the CPU.'''
+        return f'var_{hash((self.diffuse,self.specular,self.refractive_index,self.transmit,tuple(self.color),tuple(self.emittance))) % 100000000}'
         
     def glsl(self):
         color = glsl_vec3(self.color)
@@ -42,6 +54,67 @@ class SurfaceProp:
         ''']
         return f'{self.name}',frags
         
+class SurfacePropArray:
+    '''Structure-of-arrays storage for the SurfaceProp at many points'''
+    
+    fields = ('diffuse','specular','transmit','refractive_index','color','emittance')
+    
+    def __init__(self,n):
+        self.diffuse = np.zeros(n,dtype=np.float32)
+        self.specular = np.zeros(n,dtype=np.float32)
+        self.transmit = np.zeros(n,dtype=np.float32)
+        self.refractive_index = np.ones(n,dtype=np.float32)
+        self.color = np.zeros((n,3),dtype=np.float32)
+        self.emittance = np.zeros((n,3),dtype=np.float32)
+        
+    @staticmethod
+    def uniform(prop,n):
+        '''Every point has the SurfaceProp prop'''
+        arr = SurfacePropArray(n)
+        arr.fill(slice(None),prop)
+        return arr
+        
+    @staticmethod
+    def emitting(emittance,**kwargs):
+        '''Points with the given (N,3) emittance, and otherwise the SurfaceProp with kwargs'''
+        arr = SurfacePropArray.uniform(SurfaceProp(**kwargs),len(emittance))
+        arr.emittance[:] = emittance
+        return arr
+        
+    @staticmethod
+    def from_props(props):
+        '''Converts a sequence of SurfaceProp, streaming each field straight into 
+           its array rather than through an intermediate list'''
+        n = len(props)
+        arr = SurfacePropArray(n)
+        if n == 0:
+            return arr
+        for f in SurfacePropArray.fields:
+            get,dest = attrgetter(f),getattr(arr,f)
+            if dest.ndim == 1:
+                dest[:] = np.fromiter(map(get,props),dtype=dest.dtype,count=n)
+            else:
+                dest[:] = np.fromiter(chain.from_iterable(map(get,props)),dtype=dest.dtype,count=dest.size).reshape(dest.shape)
+        return arr
+        
+    def fill(self,mask,prop):
+        '''Sets the points selected by mask to the SurfaceProp prop'''
+        for f in SurfacePropArray.fields:
+            getattr(self,f)[mask] = getattr(prop,f)
+        
+    def __len__(self):
+        return len(self.diffuse)
+        
+    def __getitem__(self,mask):
+        arr = SurfacePropArray.__new__(SurfacePropArray)
+        for f in SurfacePropArray.fields:
+            setattr(arr,f,getattr(self,f)[mask])
+        return arr
+        
+    def __setitem__(self,mask,other):
+        for f in SurfacePropArray.fields:
+            getattr(self,f)[mask] = getattr(other,f)
+        
 class Surface:
     '''A paramaterized surface that returns SurfaceProp as a function of position'''
     
@@ -54,6 +127,17 @@ class Surface:
     def fn(self,pts):
         raise Exception('Use a Surface implementation, instead!')
         
+    def props(self,pts):
+        '''Returns the SurfacePropArray at pts, which implementations can build 
+           without going through SurfaceProp objects, either here or by 
+           returning one from fn'''
+        props = self(pts)
+        return props if isinstance(props,SurfacePropArray) else SurfacePropArray.from_props(props)
+        
+    def uniform_prop(self):
+        '''The SurfaceProp everywhere on this surface, or None if it varies'''
+        return None
+        
     def glsl(self):
         raise Exception(f'{type(self)} does not implement glsl')
         
@@ -68,6 +152,12 @@ class UniformSurface(Surface):
     def fn(self,pts):
         return np.full(len(pts),self.prop)
         
+    def props(self,pts):
+        return SurfacePropArray.uniform(self.prop,len(pts))
+        
+    def uniform_prop(self):
+        return self.prop
+        
     def glsl(self):
         prop,frags = self.prop.glsl()
         frags.append(UniformSurface.glsl_function)
@@ -90,13 +180,22 @@ class CheckerSurface(Surface):
         self.b_v = N(A(b_v))
         
     def fn(self,pts):
-        a_c = np.sum(pts*self.a_v,axis=-1)
-        b_c = np.sum(pts*self.b_v,axis=-1)
-        a_c = np.mod(a_c,2*self.checker_size)
-        b_c = np.mod(b_c,2*self.checker_size)
-        a_odd = a_c >= self.checker_size
-        b_odd = b_c >= self.checker_size
-        return np.where(a_odd == b_odd,self.a,self.b)
+        return np.where(self.checks(pts),self.a,self.b)
+        
+    def props(self,pts):
+        arr = SurfacePropArray.uniform(self.b,len(pts))
+        arr.fill(self.checks(pts),self.a)
+        return arr
+        
+    def checks(self,pts):
+        '''True where pts fall on the squares with properties a'''
+        if HAVE_NUMBA:
+            out = np.empty(len(pts),dtype=bool)
+            checker_squares(np.ascontiguousarray(pts),self.a_v,self.b_v,float(self.checker_size),out)
+            return out
+        a_c = np.floor(dot(pts,self.a_v)/self.checker_size).astype(np.int64)
+        b_c = np.floor(dot(pts,self.b_v)/self.checker_size).astype(np.int64)
+        return ((a_c ^ b_c) & 1) == 0 # same parity of square along each axis
         
     def glsl(self):
         aprop,afrags = self.a.glsl()
@@ -124,99 +223,141 @@ class LimbDarkening(Surface):
     def __init__(self,emittance=[1,0.7,0]):
         self.emittance = A(emittance)
     def fn(self,pts,dirs):
-        perpness = np.sum(-N(pts)*dirs,axis=-1) #only works for spheres... [0,1]
-        return np.asarray([SurfaceProp(emittance=x**0.7*self.emittance) for x in perpness])
+        perpness = -dot(N(pts),dirs) #only works for spheres... [0,1]
+        return SurfacePropArray.emitting(perpness[:,None]**0.7*self.emittance)
         
 class PerlinSurface(Surface):
-    def __init__(self,emittance,length_scale=1.0,feature_count=10):
+    # corners of a lattice cell, offset along (x,y,z), with x varying fastest
+    corners = np.asarray([[0,0,0],[1,0,0],[0,1,0],[1,1,0],[0,0,1],[1,0,1],[0,1,1],[1,1,1]])
+    
+    def __init__(self,emittance,length_scale=1.0,feature_count=10,dtype=np.float32,seed=None):
+        '''The lattice, and so the noise, is evaluated with dtype precision. The 
+           gradients are random, and reproducible for a given seed.'''
         self.emittance = emittance
+        self.dtype = dtype
         self.length_scale = length_scale
         self.feature_count = feature_count
         lattice_points = feature_count**3
-        self.lattice_vecs = N(np.random.normal(0,1,size=lattice_points*3).reshape((feature_count,feature_count,feature_count,3)))
-        #fixups
-        self.lattice_vecs[-1,:,:] = self.lattice_vecs[0,:,:]
-        self.lattice_vecs[:,-1,:] = self.lattice_vecs[:,0,:]
-        self.lattice_vecs[:,:,-1] = self.lattice_vecs[:,:,0]
+        self.lattice_vecs = np.random.default_rng(seed).standard_normal((feature_count,feature_count,feature_count,3),dtype=dtype)
+        self.lattice_vecs /= L(self.lattice_vecs)[...,None]
         self.lattice_vecs = self.lattice_vecs.reshape(lattice_points,3)
-        self.dim = np.linspace(0,length_scale,feature_count)
-        self.lattice = A([(self.dim[i],self.dim[j],self.dim[k]) for i in range(feature_count) for j in range(feature_count) for k in range(feature_count)])
-        self.idx = np.arange(feature_count)
         self.indexer = A([1,feature_count,feature_count*feature_count],np.int32)
+        self._local = threading.local()
+        self._device_vecs = None # copied to the GPU on first use
         
-    def fn(self,pts,dirs):
-        p_mod = np.mod(pts,self.length_scale)
-        p_lat = np.interp(p_mod,self.dim,self.idx)
-        p_cell,p_lat_l = np.modf(p_lat)
-        p_lat_l = p_lat_l.astype(np.int32)
-        dx = 1
-        dy = self.feature_count
-        dz = self.feature_count**2
-        a = np.sum(p_lat_l*self.indexer,axis=-1)
-        b = a+dx
-        c = a+dy
-        d = a+dx+dy
-        e = a+dz
-        f = a+dx+dz
-        g = a+dy+dz
-        h = a+dx+dy+dz
-        
-        a = self.vec_helper(pts,a,b,p_cell[:,0])
-        b = self.vec_helper(pts,c,d,p_cell[:,0])
-        c = self.vec_helper(pts,e,f,p_cell[:,0])
-        d = self.vec_helper(pts,g,h,p_cell[:,0])
-        
-        a = self.interpolate(a,b,p_cell[:,1])
-        b = self.interpolate(c,d,p_cell[:,1])
-        
-        result = self.interpolate(a,b,p_cell[:,2])
-        result = np.maximum(result/4/np.sqrt(2)+0.5,0) # 0-1
-        result = result*0.5+0.5
-        #print(np.min(result),np.mean(result),np.max(result))
-        return np.asarray([SurfaceProp(emittance=r*self.emittance) for r in result])
-    
-    def vec_helper(self,pts,a,b,frac):
-        a = np.sum(self.lattice_vecs[a]*(pts-self.lattice[a]),axis=-1)
-        b = np.sum(self.lattice_vecs[b]*(pts-self.lattice[b]),axis=-1)
-        return self.interpolate(a,b,frac)
+    def fn(self,pts,dirs=None):
+        return SurfacePropArray.emitting(self.noise(pts)[:,None]*self.emittance)
+        
+    def noise(self,pts):
+        '''The noise at each point, in [0.5,1]'''
+        if HAVE_CUDA and len(pts) >= CUDA_MIN_POINTS:
+            if self._device_vecs is None:
+                self._device_vecs = cuda.to_device(self.lattice_vecs)
+            out = cuda.device_array(len(pts),dtype=self.dtype)
+            perlin_noise_cuda[(len(pts)+BLOCK-1)//BLOCK,BLOCK](cuda.to_device(np.ascontiguousarray(pts,dtype=self.dtype)),
+                                                              self._device_vecs,self.length_scale,self.feature_count,out)
+            return out.copy_to_host()
+        if HAVE_NUMBA:
+            out = np.empty(len(pts),dtype=self.dtype)
+            perlin_noise(np.ascontiguousarray(pts,dtype=self.dtype),self.lattice_vecs,self.length_scale,self.feature_count,out)
+            return out
+        n = len(pts)
+        pts = np.asarray(pts,dtype=self.dtype)
+        scratch = self.scratch()
+        p_cell = scratch.get('p_cell',(n,3),self.dtype)
+        spacing = self.dtype(self.length_scale/self.feature_count)
+        np.mod(pts,self.length_scale,out=p_cell)
+        p_cell /= spacing # uniform lattice, so no search
+        lo = scratch.get('lo',(n,3),np.intp)
+        np.floor(p_cell,out=lo,casting='unsafe')
+        np.minimum(lo,self.feature_count-1,out=lo) # np.mod can round up onto length_scale
+        p_cell -= lo
+        hi = scratch.get('hi',(n,3),np.intp)
+        np.add(lo,1,out=hi)
+        hi[hi == self.feature_count] = 0 # wrap, so the lattice repeats
+        lo *= self.indexer
+        hi *= self.indexer
+        hi -= lo # far corner is lo plus this along each axis
+        corners = scratch.get('corners',(n,8),np.intp)
+        np.matmul(hi,PerlinSurface.corners.T,out=corners)
+        corners += lo.sum(axis=1)[:,None]
+        
+        dots = scratch.get('dots',(n,8),self.dtype)
+        g = scratch.get('g',(n,8,3),self.dtype)
+        v = scratch.get('v',(n,8,3),self.dtype)
+        np.subtract(p_cell[:,None,:],PerlinSurface.corners,out=v) # offsets in units of cells
+        np.take(self.lattice_vecs,corners,axis=0,out=g)
+        np.einsum('nkd,nkd->nk',g,v,out=dots)
+        
+        t = scratch.get('t',(n,),self.dtype)
+        for a,b,axis in ((0,1,0),(2,3,0),(4,5,0),(6,7,0),(0,2,1),(4,6,1),(0,4,2)):
+            self.blend(dots[:,a],dots[:,b],p_cell[:,axis],t)
+        
+        result = np.divide(dots[:,0],self.dtype(4*np.sqrt(2)))
+        result += 0.5
+        np.maximum(result,0,out=result) # 0-1
+        result *= 0.5
+        result += 0.5
+        return result
+        
+    def scratch(self):
+        '''Buffers for the numpy evaluation, one set per rendering thread'''
+        scratch = getattr(self._local,'scratch',None)
+        if scratch is None:
+            scratch = self._local.scratch = Scratch()
+        return scratch
     
-    def interpolate(self,a,b,frac):
-        #return a*frac+b*(1.0-frac)
-        return (b - a) * (3.0 - frac * 2.0) * frac * frac + a;
+    @staticmethod
+    def blend(a,b,frac,t):
+        '''Smoothly interpolates from a to b by frac in place in a, using b and t as scratch'''
+        #a*frac+b*(1.0-frac)
+        np.multiply(frac,-2.0,out=t)
+        t += 3.0
+        t *= frac
+        t *= frac
+        b -= a
+        b *= t
+        a += b
         
 def _sphere_to_cube(xyz):
     '''ratio between the distance along a line from the center to the surface of a unit cube
        in the same direction as a given ray to the surface of a unit sphere.'''
-    return np.sqrt(np.sum(np.square(xyz),axis=-1))/np.max(np.abs(xyz),axis=-1)
+    return L(xyz)/np.max(np.abs(xyz),axis=-1)
 
 def sphere_to_cube(theta,phi):
     '''spherical coordinates theta,phi to x,y,z positions on a unit cube'''
-    xyz = A([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)]).T
-    return xyz*_sphere_to_cube(xyz)
+    st = np.sin(theta)
+    xyz = np.stack([st*np.cos(phi), st*np.sin(phi), np.cos(theta)],axis=-1)
+    return xyz*_sphere_to_cube(xyz)[...,None]
+
+# Per face 2*axis+(coordinate along axis > 0) of the cube: the two coordinates 
+# across the face, and where the face sits in the unfolded cube map
+CUBE_FACE_AXES = np.asarray([[1,2],[1,2],[0,2],[0,2],[1,0],[1,0]])
+CUBE_FACE_OFFSETS = A([[3096,1024],[1024,1024],[2048,1024],[0,1024],[0,2048],[2048,0]])
 
 class SphereCubeMap(Surface):
-    def __init__(self,cube_map):
-        self.cube_map = A(np.asarray(cube_map)[:,:,:3])/255
-    def fn(self,pts,dirs):
-        xyz = 512*(pts.T*_sphere_to_cube(pts)).T
-        xyz[xyz>512] = 512
-        xyz[xyz<-512] = -512
-        print(np.min(xyz),np.max(xyz))
+    def __init__(self,cube_map,dtype=np.float32):
+        self.cube_map = np.asarray(cube_map)[:,:,:3].astype(dtype)/dtype(255)
+        
+    def fn(self,pts,dirs=None):
+        return SurfacePropArray.emitting(self.texels(pts),diffuse=0,specular=0)
+        
+    def texels(self,pts):
+        '''The cube map color in the direction of each point'''
+        if HAVE_NUMBA:
+            pixels = np.empty((len(pts),2),dtype=np.int64)
+            cube_map_pixels(np.ascontiguousarray(pts),CUBE_FACE_AXES,CUBE_FACE_OFFSETS,pixels)
+        else:
+            pixels = self.pixels(pts)
+        return self.cube_map[pixels[:,1],pixels[:,0]]
+        
+    def pixels(self,pts):
+        '''The (column,row) of the texel in the direction of each point'''
+        xyz = 512*pts*_sphere_to_cube(pts)[:,None]
+        np.clip(xyz,-512,512,out=xyz)
         axis = np.argmax(np.abs(xyz),axis=-1)
-        pos = np.sign(np.take_along_axis(xyz,np.expand_dims(axis, axis=-1), axis=-1).squeeze()) > 0
-        xy = np.empty((len(xyz),2))
-        if np.any(m_front := (axis == 1) & pos):
-            xy[m_front] = xyz[:,[0,2]][m_front] + A([0,1024])
-        if np.any(m_right := (axis == 0) & pos):
-            xy[m_right] = xyz[:,[1,2]][m_right] + A([1024,1024])
-        if np.any(m_back := (axis == 1) & ~pos):
-            xy[m_back] = xyz[:,[0,2]][m_back] + A([2048,1024])
-        if np.any(m_left := (axis == 0) & ~pos):
-            xy[m_left] = xyz[:,[1,2]][m_left] + A([3096,1024])
-        if np.any(m_top := (axis == 2) & pos):
-            xy[m_top] = xyz[:,[1,0]][m_top] + A([2048,0])
-        if np.any(m_bot := (axis == 2) & ~pos):
-            xy[m_bot] = xyz[:,[1,0]][m_bot] + A([0,2048])
+        pos = np.take_along_axis(xyz,axis[:,None],axis=-1)[:,0] > 0
+        face = 2*axis + pos
+        xy = np.take_along_axis(xyz,CUBE_FACE_AXES[face],axis=-1) + CUBE_FACE_OFFSETS[face]
 
-        pixels = np.floor(xy+512).astype(np.uint32)
-        return np.asarray([SurfaceProp(diffuse=0,specular=0,emittance=e) for e in self.cube_map[pixels[:,1],pixels[:,0]]])
+        return np.floor(xy+512).astype(np.uint32)
@@ -16,12 +16,13 @@
 #    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
 
 from .parameter import *
+from functools import lru_cache
 import numpy as np
     
     
 def glsl_float(val):
     '''Converts a float value or Parameter to a GLSL statement'''
-    return str(val) if isinstance(val,Parameter) else f'{float(val)}'
+    return str(val) if isinstance(val,(Parameter,np.float32)) else f'{float(val)}'
     
 def glsl_vec3(listlike):
     '''Converts a length-3 listlike of float or Parameter values to a GLSL vec3'''
@@ -42,42 +43,128 @@ def A(listlike,dtype=np.float64):
         listlike = [params[0].wrap(l) for l in listlike]
     return np.asarray(listlike,dtype=dtype)
 
+def dot(a,b):
+    '''Dot product across the last axis, without an intermediate product array'''
+    return np.einsum('...i,...i->...',a,b)
+
 def L(arr):
     '''Computes the euclidean length across the last axis'''
-    return np.sqrt(np.sum(arr*arr,axis=-1))
+    return np.sqrt(dot(arr,arr))
 
 def N(arr):
-    '''Normalizes vectors across the last axis'''
-    return (arr.T/L(arr)).T
+    '''Normalizes vectors across the last axis, dividing once per vector rather 
+       than once per component'''
+    return arr*(1/L(arr))[...,None]
+    
+def cross3(a,b,out=None):
+    '''Cross product across the last axis, without the overhead of np.cross'''
+    if out is None:
+        out = np.empty(np.broadcast_shapes(a.shape,b.shape),dtype=np.result_type(a,b))
+    ax,ay,az = a[...,0],a[...,1],a[...,2]
+    bx,by,bz = b[...,0],b[...,1],b[...,2]
+    out[...,0] = ay*bz-az*by
+    out[...,1] = az*bx-ax*bz
+    out[...,2] = ax*by-ay*bx
+    return out
+    
+@lru_cache(maxsize=256)
+def _rotation(axis,ang):
+    '''Read-only rotation matrix about axis 0, 1, or 2 for a float angle'''
+    rot = _rotation_matrix(axis,ang)
+    rot.setflags(write=False)
+    return rot
+    
+def _rotation_matrix(axis,ang):
+    ca,sa = np.cos(ang),np.sin(ang)
+    if axis == 0:
+        return np.asarray([A([1,0,0]),A([0,ca,-sa]),A([0,sa,ca])])
+    elif axis == 1:
+        return np.asarray([A([ca,0,sa]),A([0,1,0]),A([-sa,0,ca])])
+    else:
+        return np.asarray([A([ca,-sa,0]),A([sa,ca,0]),A([0,0,1])])
+        
+def _rotate(axis,ang):
+    '''Matrices for numeric angles are shared between calls, Parameters stay symbolic'''
+    if isinstance(ang,Parameter):
+        return _rotation_matrix(axis,ang)
+    return _rotation(axis,float(ang))
     
 def XROT(ang):
     '''3D Rotation matrix about X axis'''
-    ca,sa = np.cos(ang),np.sin(ang)
-    return np.asarray([A([1,0,0]),A([0,ca,-sa]),A([0,sa,ca])])
+    return _rotate(0,ang)
     
 def YROT(ang):
     '''3D Rotation matrix about Y axis'''
-    ca,sa = np.cos(ang),np.sin(ang)
-    return np.asarray([A([ca,0,sa]),A([0,1,0]),A([-sa,0,ca])])
+    return _rotate(1,ang)
     
 def ZROT(ang):
     '''3D Rotation matrix about Z axis'''
-    ca,sa = np.cos(ang),np.sin(ang)
-    return np.asarray([A([ca,-sa,0]),A([sa,ca,0]),A([0,0,1])])
+    return _rotate(2,ang)
+    
+def euler_to_mat(seq,angles):
+    '''3D Rotation matrix from Euler angles about the axes in seq, following the 
+       scipy convention: lowercase axes are extrinsic, uppercase are intrinsic'''
+    rots = [{'x':XROT,'y':YROT,'z':ZROT}[axis.lower()](ang) for axis,ang in zip(seq,angles)]
+    if seq.islower():
+        rots = rots[::-1]
+    mat = rots[0]
+    for rot in rots[1:]:
+        mat = mat @ rot
+    return mat
 
 D_ = 1e-4
-DX = A([D_,0,0])
+DX = A([D_,0,0]) # float64, since D_ is near the resolution of float32 points
 DY = A([0,D_,0])
 DZ = A([0,0,D_])
+G_SHIFTS = np.stack([DX,-DX,DY,-DY,DZ,-DZ])
 
 def G(sdf,pts):
-    '''Computes the gradient of the SDF scalar field'''
-    return A([sdf(pts+DX)-sdf(pts-DX),
-              sdf(pts+DY)-sdf(pts-DY),
-              sdf(pts+DZ)-sdf(pts-DZ)]).T/(2*D_)
+    '''Computes the gradient of the SDF scalar field, evaluating all six 
+       offsets of every point in one call'''
+    s = sdf((pts[None,:,:]+G_SHIFTS[:,None,:]).reshape(-1,3)).reshape(6,len(pts))
+    return np.stack([s[0]-s[1],s[2]-s[3],s[4]-s[5]],axis=-1)/(2*D_)
               
+class Scratch:
+    '''Reusable buffers, grown as needed, e.g. shared by each bounce of `render.march_many`'''
+    
+    def __init__(self):
+        self.buffers = {}
+        
+    def get(self,name,shape,dtype=np.float32):
+        '''An uninitialized array of shape, viewing the buffer called name'''
+        buf = self.buffers.get(name)
+        if buf is None or len(buf) < shape[0] or buf.shape[1:] != shape[1:] or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape,dtype=dtype)
+        return buf[:shape[0]]
+        
 class Rays:
-    '''A sometimes-used class for storing the [p]osition and [d]irection of some rays'''
-    def __init__(self,p=A([[0,0,0]]),d=A([[0,0,1]])):
-        self.p = p
-        self.d = d
+    '''A sometimes-used class for storing the [p]osition and [d]irection of some rays.
+       Both live side by side in one (N,6) array, buf, so selecting a subset of 
+       rays gathers p and d together in one pass. A single p (or d) is broadcast 
+       to every ray.'''
+    def __init__(self,p=A([[0,0,0]]),d=A([[0,0,1]]),buf=None):
+        if buf is None:
+            p,d = np.broadcast_arrays(p,d)
+            buf = np.empty(p.shape[:-1]+(6,),dtype=np.result_type(p,d))
+            buf[...,:3] = p
+            buf[...,3:] = d
+        self.buf = buf
+        
+    @property
+    def p(self):
+        return self.buf[...,:3]
+        
+    @property
+    def d(self):
+        return self.buf[...,3:]
+        
+    def __len__(self):
+        return len(self.buf)
+        
+    def __getitem__(self,idx):
+        return Rays(buf=self.buf[idx])
+        
+    @staticmethod
+    def concatenate(rays):
+        '''Joins a sequence of Rays into one'''
+        return Rays(buf=np.concatenate([r.buf for r in rays]))
@@ -0,0 +1,63 @@
+#    Copyright 2022 by Benjamin J. Land (a.k.a. BenLand100)
+#
+#    This file is part of sdfray.
+#
+#    sdfray is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sdfray is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
+
+from sdfray import *
+from sdfray.jit import specialized_source,specialize_kernels,generic,FusedSDF
+import numpy as np
+
+def _indent(line):
+    return len(line)-len(line.lstrip())
+    
+def _bounded_tree():
+    '''A union with a bounded leaf and a bounded CSG right subtree'''
+    leaf = Box(translate=[0,5,0])
+    csg = Intersection(Sphere(translate=[3,0,0]),Box(translate=[3,0,0]))
+    return Union(Sphere(),Union(leaf,csg)).simplify()
+
+def test_bounded_right_subtrees_are_guarded():
+    '''Leaf and CSG right subtrees are only evaluated under their own bound test'''
+    ops,lchild,rchild,params,affine,rounding,bounds,skip = _bounded_tree().compile()
+    lines = specialized_source(ops,lchild,rchild,skip).split('\n')
+    roots = [b for b in skip if b >= 0]
+    assert len(roots) == 2
+    for r in roots:
+        k = next(k for k in range(len(ops)) if rchild[k] == r)
+        l,subtree = lchild[k],[n for n in range(len(ops)) if n > lchild[k] and n <= r]
+        test = lines.index(next(s for s in lines if f'bounds[{r},3] < v{l}:' in s))
+        depth = _indent(lines[test])
+        for n in subtree:
+            assert _indent(next(s for s in lines if s.strip().startswith(f'v{n} ='))) > depth
+        assert any(s.strip() == f'v{k} = v{l} - rounding[{k}]' for s in lines[test:])
+
+def test_kernels_agree_with_tree_walk():
+    '''Specialized, generic, and fused distances match the tree walk, both where 
+       the bounds prune right subtrees and where they don't'''
+    sdf = _bounded_tree()
+    tree = sdf.compile()
+    ops,lchild,rchild,params,affine,rounding,bounds,skip = tree
+    rng = np.random.default_rng(1)
+    roots = [b for b in skip if b >= 0]
+    pts = np.concatenate([rng.uniform(-8,8,(2000,3))]+[bounds[r,:3]+rng.uniform(-2,2,(500,3))*bounds[r,3] for r in roots])
+    for r in roots:
+        inside = np.linalg.norm(pts-bounds[r,:3],axis=-1) < bounds[r,3]
+        assert inside.any() and not inside.all()
+    expected = sdf.distance(pts)
+    for kernels in [generic,specialize_kernels(ops,lchild,rchild,skip)]:
+        out = np.empty(len(pts))
+        kernels.eval_tree(*tree,pts,out)
+        assert np.allclose(out,expected,rtol=1e-6,atol=1e-6)
+    assert np.allclose(FusedSDF(sdf).distance(pts),expected,rtol=1e-6,atol=1e-6)
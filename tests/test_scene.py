@@ -0,0 +1,28 @@
+#    Copyright 2022 by Benjamin J. Land (a.k.a. BenLand100)
+#
+#    This file is part of sdfray.
+#
+#    sdfray is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sdfray is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
+
+from sdfray import *
+import numpy as np
+
+def test_cpu_sdf_follows_new_tree():
+    '''Assigning a new SDF tree to a Scene rebuilds the cached CPU SDF'''
+    scene = Scene(Sphere(),[])
+    origin = np.zeros((1,3))
+    assert scene.cpu_sdf()(origin)[0] == -1.0
+    assert scene.cpu_sdf() is scene.cpu_sdf()
+    scene.sdf = Box(translate=[0,0,5])
+    assert scene.cpu_sdf()(origin)[0] == 4.5
@@ -0,0 +1,50 @@
+#    Copyright 2022 by Benjamin J. Land (a.k.a. BenLand100)
+#
+#    This file is part of sdfray.
+#
+#    sdfray is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sdfray is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with sdfray.  If not, see <https://www.gnu.org/licenses/>.
+
+from sdfray import *
+import sdfray.surface
+import numpy as np
+
+def _noise_points(surface,n=4000):
+    '''Points spread over a few periods of the noise, including negative coordinates'''
+    return np.random.default_rng(2).uniform(-2*surface.length_scale,2*surface.length_scale,(n,3))
+
+def test_perlin_noise_is_periodic():
+    '''The noise repeats every length_scale along each axis'''
+    surface = PerlinSurface([1,1,1],length_scale=3.0,feature_count=6,dtype=np.float64,seed=1)
+    pts = _noise_points(surface)
+    noise = surface.noise(pts)
+    for axis in range(3):
+        shifted = pts.copy()
+        shifted[:,axis] += surface.length_scale
+        assert np.allclose(surface.noise(shifted),noise,atol=1e-9)
+
+def test_perlin_noise_range():
+    '''The noise stays within [0.5,1] and is not constant'''
+    surface = PerlinSurface([1,1,1],seed=1)
+    noise = surface.noise(_noise_points(surface,20000))
+    assert noise.min() >= 0.5 and noise.max() <= 1.0
+    assert noise.std() > 0.01
+
+def test_perlin_noise_paths_agree(monkeypatch):
+    '''The numba kernel and the numpy fallback give the same noise'''
+    monkeypatch.setattr(sdfray.surface,'HAVE_CUDA',False)
+    surface = PerlinSurface([1,1,1],length_scale=2.0,feature_count=5,dtype=np.float64,seed=1)
+    pts = _noise_points(surface)
+    kernel = surface.noise(pts)
+    monkeypatch.setattr(sdfray.surface,'HAVE_NUMBA',False)
+    assert np.allclose(surface.noise(pts),kernel,atol=1e-9)